@@ -1,6 +1,7 @@
 #!/bin/bash
+# test all checkpoints in one run, the videos and the ground truth are loaded only once
+checkpoints=()
 for id in $( seq 101 120 );do
-checkpoint="/public/home/jm/Data/output/stm_output/models_with_coco/DAVIS17/recurrent_${id}.pth.tar"
-echo "TEST(${id}):" $checkpoint
-python test.py --checkpoint ${checkpoint}
-done
\ No newline at end of file
+checkpoints+=("/public/home/jm/Data/output/stm_output/models_with_coco/DAVIS17/recurrent_${id}.pth.tar")
+done
+python test.py --checkpoint "${checkpoints[@]}"
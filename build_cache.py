@@ -0,0 +1,24 @@
+from libs.dataset.data import DATA_CONTAINER, build_frame_cache
+
+import argparse
+
+from options import OPTION as opt
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Build the memory-mapped frame cache')
+    parser.add_argument('--dataset', default=['DAVIS17', 'VOS'], type=str, nargs='*', choices=['VOS', 'DAVIS16', 'DAVIS17'], help='datasets to cache')
+    parser.add_argument('--val', action='store_true', help='cache the validation split instead of the training split')
+    return parser.parse_args()
+
+def main():
+
+    args = parse_args()
+
+    # frames are stored near OPTION.input_size, rebuild the cache when it changes
+    for dataset in args.dataset:
+        ds = DATA_CONTAINER[dataset](train=not args.val)
+        build_frame_cache(ds, opt.input_size)
+
+if __name__ == '__main__':
+    main()
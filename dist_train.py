@@ -1,14 +1,16 @@
-from libs.dataset.data import ROOT, DATA_CONTAINER, multibatch_collate_fn
-from libs.dataset.transform import TrainTransform, TestTransform
-from libs.utils.logger import Logger, AverageMeter
+from libs.dataset.data import DATA_CONTAINER, multibatch_collate_fn, batch_count_objects
+from libs.dataset.image_data import COCODataset
+from libs.dataset.transform import TrainTransform, TestTransform, BatchAugment
+from libs.utils.logger import set_logging, AverageMeter
 from libs.utils.loss import *
 from libs.utils.utility import write_mask, save_checkpoint, adjust_learning_rate
-from libs.models.models import STM
+from libs.models.memory_bank import MemoryBank
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.utils.data as data
+import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel
 
 import numpy as np
@@ -21,59 +23,134 @@ import argparse
 import random
 from progress.bar import Bar
 from collections import OrderedDict
+import logging
 
 from options import OPTION as opt
 
 MAX_FLT = 1e6
 
+# launch with torchrun, e.g. on 4 gpus of one node
+#   torchrun --nproc_per_node=4 dist_train.py --model stm
+# or as 4 cpu processes
+#   torchrun --nproc_per_node=4 dist_train.py --model stm --backend gloo
+# opt.train_batch is the total batch size, split evenly over the processes
+
 def parse_args():
-    parser = argparse.ArgumentParser('Training Mask Segmentation')
-    parser.add_argument('--local_rank', type=int, default=0, help='default rank for dist')
+    parser = argparse.ArgumentParser('Distributed Training Mask Segmentation')
+    parser.add_argument('--model', default='stm', type=str, choices=['stm', 'cycle', 'fusion'], help='model variant to train')
+    parser.add_argument('--backend', default='nccl', type=str, choices=['nccl', 'gloo'], help='distributed backend, gloo runs on cpu')
     return parser.parse_args()
 
+def setup_seed(seed):
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.backends.cudnn.deterministic = True
+
+def build_model(name):
+    if name == 'fusion':
+        from libs.models.fusion_models import STM
+        return STM(opt, phase='train')
+    elif name == 'cycle':
+        from libs.models.cycle_models import STM
+    else:
+        from libs.models.models import STM
+    return STM(opt.keydim, opt.valdim, 'train',
+            mode=opt.mode, iou_threshold=opt.iou_threshold, top_k=opt.top_k, precision=opt.precision,
+            grad_checkpoint=opt.checkpoint_activations)
+
+def stm_loss(model, criterion, frames, masks, objs):
+    out = model(frame=frames, mask=masks, num_objects=objs)
+    # mean loss over the samples and frames
+    return criterion(out, masks[:, 1:], objs)
+
+def cycle_loss(model, criterion, frames, masks, objs):
+    T = frames.shape[1]
+    forward_out, backward_out = model(frame=frames, mask=masks, num_objects=objs)
+    # forward
+    forward_loss = criterion(forward_out, masks[:, 1:], objs)
+    # backward
+    backward_loss = criterion(backward_out, masks[:, 0:1].expand(-1, T-1, -1, -1, -1), objs)
+    return forward_loss + backward_loss
+
+def fusion_loss(model, criterion, frames, masks, objs):
+    T = frames.shape[1]
+    out, m_out = model(frame=frames, mask=masks, num_objects=objs)
+    return criterion(out, masks[:, 1:], objs) + criterion(m_out, masks[:, :T-1], objs)
+
+MODEL_LOSS = {'stm': stm_loss, 'cycle': cycle_loss, 'fusion': fusion_loss}
+
 def main(args):
+
     start_epoch = 0
-    random.seed(0)
 
-    if not os.path.isdir(opt.checkpoint):
+    # Distributed
+    dist.init_process_group(backend=args.backend, init_method='env://')
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    # seed each rank apart so that their data workers draw different augmentations,
+    # DDP broadcasts the weights of rank 0 so the models still start identical
+    setup_seed(opt.seed + rank)
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    use_gpu = args.backend == 'nccl'
+    if use_gpu:
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+
+    # Create folder
+    opt.checkpoint = osp.join(osp.join(opt.checkpoint, opt.valset))
+    if rank == 0 and not osp.exists(opt.checkpoint):
         os.makedirs(opt.checkpoint)
+    dist.barrier()
+
+    # Set logger, only the first process writes the log
+    if rank == 0:
+        set_logging(filename=os.path.join(opt.checkpoint, opt.mode+'_log.txt'), resume=opt.resume != '')
+    logger = logging.getLogger(__name__)
+    logger.info(str(opt))
+    logger.info('==> Training {} on {} processes ({})'.format(args.model, world_size, args.backend))
 
     # Data
-    print('==> Preparing dataset')
+    logger.info('==> Preparing dataset')
 
     input_dim = opt.input_size
 
-    train_transformer = TrainTransform(size=input_dim)
+    train_transformer = TrainTransform(size=input_dim, device_augment=opt.device_augment)
     test_transformer = TestTransform(size=input_dim)
 
-
     try:
         if isinstance(opt.trainset, list):
             datalist = []
             for dataset, freq, max_skip in zip(opt.trainset, opt.datafreq, opt.max_skip):
                 ds = DATA_CONTAINER[dataset](
-                    train=True, 
-                    sampled_frames=opt.sampled_frames, 
-                    transform=train_transformer, 
-                    max_skip=max_skip, 
+                    train=True,
+                    sampled_frames=opt.sampled_frames,
+                    transform=train_transformer,
+                    max_skip=max_skip,
                     samples_per_video=opt.samples_per_video
                 )
                 datalist += [ds] * freq
+            if opt.with_coco:
+                ds = COCODataset(transform=train_transformer, sampled_frames=opt.sampled_frames, ratio=opt.coco_ratio)
+                datalist += [ds]
 
             trainset = data.ConcatDataset(datalist)
 
         else:
             max_skip = opt.max_skip[0] if isinstance(opt.max_skip, list) else opt.max_skip
             trainset = DATA_CONTAINER[opt.trainset](
-                train=True, 
-                sampled_frames=opt.sampled_frames, 
-                transform=train_transformer, 
-                max_skip=max_skip, 
+                train=True,
+                sampled_frames=opt.sampled_frames,
+                transform=train_transformer,
+                max_skip=max_skip,
                 samples_per_video=opt.samples_per_video
                 )
     except KeyError as ke:
-        print('[ERROR] invalide dataset name is encountered. The current acceptable datasets are:')
-        print(list(DATA_CONTAINER.keys()))
+        logger.error('invalide dataset name is encountered. The current acceptable datasets are:')
+        logger.info(list(DATA_CONTAINER.keys()))
         exit()
 
     testset = DATA_CONTAINER[opt.valset](
@@ -81,23 +158,28 @@ def main(args):
         transform=test_transformer,
         samples_per_video=1
         )
-    train_sampler = torch.utils.data.distributed.DistributedSampler(trainset)
-    trainloader = data.DataLoader(trainset, batch_size=opt.train_batch, shuffle=False, sampler=train_sampler, pin_memory=True,
-                                  num_workers=opt.workers, collate_fn=multibatch_collate_fn, drop_last=True)
-                                  
-    test_sampler = torch.utils.data.distributed.DistributedSampler(testset)
-    testloader = data.DataLoader(testset, batch_size=1, shuffle=False, sampler=test_sampler, pin_memory=True,
+
+    # every process reads its own shard of the concatenated samples
+    assert opt.train_batch % world_size == 0
+    train_sampler = data.distributed.DistributedSampler(trainset, num_replicas=world_size, rank=rank, shuffle=True, seed=opt.seed)
+    # worker options are only accepted with worker processes
+    loader_args = {'persistent_workers': True, 'prefetch_factor': opt.prefetch_factor} if opt.workers > 0 else {}
+    trainloader = data.DataLoader(trainset, batch_size=opt.train_batch // world_size, sampler=train_sampler, pin_memory=use_gpu,
+                                  num_workers=opt.workers, collate_fn=multibatch_collate_fn, drop_last=True, **loader_args)
+
+    # validation videos are only run by the first process
+    testloader = data.DataLoader(testset, batch_size=1, shuffle=False, pin_memory=use_gpu,
                                  num_workers=opt.workers, collate_fn=multibatch_collate_fn)
     # Model
-    print("==> creating model")
+    logger.info("==> creating model")
 
-    net = STM(opt.keydim, opt.valdim, 'train', 
-            mode=opt.mode, iou_threshold=opt.iou_threshold)
-    print('    Total params: %.2fM' % (sum(p.numel() for p in net.parameters())/1000000.0))
+    net = build_model(args.model)
+    logger.info('    Total params: %.2fM' % (sum(p.numel() for p in net.parameters())/1000000.0))
     net.eval()
-    
-    net = net.cuda()
-    net = DistributedDataParallel(net, device_ids=[args.local_rank], output_device=args.local_rank)
+    net.to(device)
+
+    # batchnorm is frozen, its buffers do not need to be synchronized every step
+    net = DistributedDataParallel(net, device_ids=[local_rank] if use_gpu else None, broadcast_buffers=False)
 
     # set training parameters
     for p in net.parameters():
@@ -105,20 +187,20 @@ def main(args):
 
     # Strateges
     criterion = None
-    celoss = cross_entropy_loss
+    celoss = batch_cross_entropy_loss
 
     if opt.loss == 'ce':
         criterion = celoss
     elif opt.loss == 'iou':
-        criterion = mask_iou_loss
+        criterion = batch_mask_iou_loss
     elif opt.loss == 'both':
-        criterion = lambda pred, target, obj: celoss(pred, target, obj) + mask_iou_loss(pred, target, obj)
+        criterion = lambda pred, target, obj: celoss(pred, target, obj) + batch_mask_iou_loss(pred, target, obj)
     else:
         raise TypeError('unknown training loss %s' % opt.loss)
-    
+
     # Optimization
     optimizer = None
-    
+
     if opt.solver == 'sgd':
 
         optimizer = optim.SGD(net.parameters(), lr=opt.learning_rate,
@@ -130,26 +212,25 @@ def main(args):
     else:
         raise TypeError('unkown solver type %s' % opt.solver)
 
+    # fp16 gradients are scaled to avoid underflow, bf16 and fp32 need no scaling
+    # loss scaling is CUDA only, it stays disabled for cpu and bf16 / fp32 runs
+    scaler = torch.cuda.amp.GradScaler(enabled=opt.precision == 'fp16' and use_gpu)
+
     # Resume
     title = 'STM'
     minloss = float('inf')
 
-    opt.checkpoint = osp.join(osp.join(opt.checkpoint, opt.valset))
-    if not osp.exists(opt.checkpoint):
-        os.mkdir(opt.checkpoint)
-
     if opt.resume:
         # Load checkpoint.
-        print('==> Resuming from checkpoint {}'.format(opt.resume))
+        logger.info('==> Resuming from checkpoint {}'.format(opt.resume))
         assert os.path.isfile(opt.resume), 'Error: no checkpoint directory found!'
-        # opt.checkpoint = os.path.dirname(opt.resume)
-        checkpoint = torch.load(opt.resume)
+        checkpoint = torch.load(opt.resume, map_location=device)
         minloss = checkpoint['minloss']
         start_epoch = checkpoint['epoch']
         net.load_state_dict(checkpoint['state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer'])
         skips = checkpoint['max_skip']
-        
+
         try:
             if isinstance(skips, list):
                 for idx, skip in enumerate(skips):
@@ -157,53 +238,55 @@ def main(args):
             else:
                 trainloader.dataset.set_max_skip(skip)
         except:
-            print('[Warning] Initializing max skip fail')
-
-        logger = Logger(os.path.join(opt.checkpoint, opt.mode+'_log.txt'), resume=True)
+            logger.warning('Initializing max skip fail')
     else:
         if opt.initial:
-            print('==> Initialize model with weight file {}'.format(opt.initial))
-            weight = torch.load(opt.initial)
+            logger.info('==> Initialize model with weight file {}'.format(opt.initial))
+            weight = torch.load(opt.initial, map_location=device)
             if isinstance(weight, OrderedDict):
                 net.module.load_param(weight)
             else:
                 net.module.load_param(weight['state_dict'])
-
-        logger = Logger(os.path.join(opt.checkpoint, opt.mode+'_log.txt'), resume=False)
         start_epoch = 0
 
-    logger.set_items(['Epoch', 'LR', 'Train Loss'])
-
     # Train and val
     for epoch in range(start_epoch):
         adjust_learning_rate(optimizer, epoch, opt)
 
     for epoch in range(start_epoch, opt.epochs):
 
-        print('\nEpoch: [%d | %d] LR: %f' % (epoch + 1, opt.epochs, opt.learning_rate))
+        logger.info('Epoch: [%d | %d] LR: %f' % (epoch + 1, opt.epochs, opt.learning_rate))
         adjust_learning_rate(optimizer, epoch, opt)
 
+        # reshuffle the shards every epoch
+        train_sampler.set_epoch(epoch)
+
         net.module.phase = 'train'
         train_loss = train(trainloader,
                            model=net,
+                           loss_fn=MODEL_LOSS[args.model],
                            criterion=criterion,
                            optimizer=optimizer,
+                           scaler=scaler,
                            epoch=epoch,
+                           device=device,
                            iter_size=opt.iter_size,
-                           mode=opt.mode,
-                           threshold=opt.iou_threshold)
+                           verbose=rank == 0)
 
         if (epoch + 1) % opt.epoch_per_test == 0:
-            net.module.phase = 'test'
-            test(testloader,
-                 model=net.module,
-                 criterion=criterion,
-                 epoch=epoch)
+            if rank == 0:
+                net.module.phase = 'test'
+                test(testloader,
+                     model=net.module,
+                     epoch=epoch,
+                     device=device)
+            dist.barrier()
 
         # append logger file
-        logger.log(epoch+1, opt.learning_rate, train_loss)
+        log_format = 'Epoch: {} LR: {} Loss: {}'
+        logger.info(log_format.format(epoch+1, opt.learning_rate, train_loss))
 
-        # adjust max skip
+        # adjust max skip, every process keeps its own datasets in step
         if (epoch + 1) % opt.epochs_per_increment == 0:
             if isinstance(trainloader.dataset, data.ConcatDataset):
                 for dataset in trainloader.dataset.datasets:
@@ -211,28 +294,28 @@ def main(args):
             else:
                 trainloader.dataset.increase_max_skip()
 
-        # save model  
+        # save model
         is_best = train_loss <= minloss
         minloss = min(minloss, train_loss)
         skips = [ds.max_skip for ds in trainloader.dataset.datasets] \
                 if isinstance(trainloader.dataset, data.ConcatDataset) \
                  else trainloader.dataset.max_skip
 
-        save_checkpoint({
-            'epoch': epoch + 1,
-            'state_dict': net.state_dict(),
-            'loss': train_loss,
-            'minloss': minloss,
-            'optimizer': optimizer.state_dict(),
-            'max_skip': skips,
-        }, epoch + 1, is_best, checkpoint=opt.checkpoint, filename=opt.mode, freq=opt.save_model_freq)
+        if rank == 0:
+            save_checkpoint({
+                'epoch': epoch + 1,
+                'state_dict': net.state_dict(),
+                'loss': train_loss,
+                'minloss': minloss,
+                'optimizer': optimizer.state_dict(),
+                'max_skip': skips,
+            }, epoch + 1, is_best, checkpoint=opt.checkpoint, filename=opt.mode, freq=opt.save_model_freq)
 
-    logger.close()
+    logger.info('minimum loss: {}'.format(minloss))
 
-    print('minimum loss:')
-    print(minloss)
+    dist.destroy_process_group()
 
-def train(trainloader, model, criterion, optimizer, epoch, iter_size, mode, threshold):
+def train(trainloader, model, loss_fn, criterion, optimizer, scaler, epoch, device, iter_size, verbose):
     # switch to train mode
 
     data_time = AverageMeter()
@@ -240,61 +323,68 @@ def train(trainloader, model, criterion, optimizer, epoch, iter_size, mode, thre
 
     end = time.time()
 
-    bar = Bar('Processing', max=len(trainloader))
+    if verbose:
+        bar = Bar('Processing', max=len(trainloader))
     optimizer.zero_grad()
+    augment = BatchAugment() if opt.device_augment else None
 
     for batch_idx, data in enumerate(trainloader):
         frames, masks, objs, infos = data
         # measure data loading time
         data_time.update(time.time() - end)
-        frames = frames.cuda()
-        masks = masks.cuda()
-        objs = objs.cuda()
 
-        objs[objs==0] = 1
+        frames = frames.to(device)
+        masks = masks.to(device)
+        objs = objs.to(device)
 
-        N, T, C, H, W = frames.size()
-        max_obj = masks.shape[2]-1
+        if augment is not None:
+            frames, masks = augment(frames, masks, infos)
+            # count the objects left after augmentation as on the CPU path
+            objs = batch_count_objects(masks)
 
-        total_loss = 0.0
-        out = model(frame=frames, mask=masks, num_objects=objs)
-        for idx in range(N):
-            for t in range(1, T):
-                gt = masks[idx, t:t+1]
-                pred = out[idx, t-1: t]
-                No = objs[idx].item()
-                    
-                total_loss = total_loss + criterion(pred, gt, No)
+        objs[objs==0] = 1
 
-        total_loss = total_loss / (N * (T-1))
+        # gradients are averaged over the processes, so the mean of the per-process
+        # losses matches the loss of the whole batch
+        total_loss = loss_fn(model, criterion, frames, masks, objs)
 
-        # record loss
-        if total_loss.item() > 0.0:
-            loss.update(total_loss.item(), 1)
+        # record loss averaged over the processes
+        batch_loss = total_loss.detach().clone()
+        dist.all_reduce(batch_loss)
+        batch_loss = batch_loss.item() / dist.get_world_size()
+        if batch_loss > 0.0:
+            loss.update(batch_loss, 1)
 
         # compute gradient and do SGD step (divided by accumulated steps)
         total_loss /= iter_size
-        total_loss.backward()
-
         if (batch_idx+1) % iter_size == 0:
-            optimizer.step()
+            scaler.scale(total_loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             model.zero_grad()
+        else:
+            # accumulate locally, gradients are only synchronized on the stepping iteration
+            with model.no_sync():
+                scaler.scale(total_loss).backward()
 
         # measure elapsed time
         end = time.time()
         # plot progress
-        bar.suffix  = '({batch}/{size}) Data: {data:.3f}s |Loss: {loss:.5f}'.format(
-            batch=batch_idx + 1,
-            size=len(trainloader),
-            data=data_time.val,
-            loss=loss.avg
-        )
-        bar.next()
-    bar.finish()
+        if verbose:
+            bar.suffix  = '({batch}/{size}) Data: {data:.3f}s |Loss: {loss_val:.5f}({loss_avg:.5f})'.format(
+                batch=batch_idx + 1,
+                size=len(trainloader),
+                data=data_time.val,
+                loss_val=loss.val,
+                loss_avg=loss.avg
+            )
+            bar.next()
+    if verbose:
+        bar.finish()
 
     return loss.avg
 
-def test(testloader, model, criterion, epoch):
+def test(testloader, model, epoch, device):
 
     data_time = AverageMeter()
 
@@ -304,9 +394,10 @@ def test(testloader, model, criterion, epoch):
         for batch_idx, data in enumerate(testloader):
 
             frames, masks, objs, infos = data
-            frames = frames.cuda()
-            masks = masks.cuda()
-                
+
+            frames = frames.to(device)
+            masks = masks.to(device)
+
             frames = frames[0]
             masks = masks[0]
             num_objects = objs[0]
@@ -317,8 +408,7 @@ def test(testloader, model, criterion, epoch):
 
             T, _, H, W = frames.shape
             pred = [masks[0:1]]
-            keys = []
-            vals = []
+            memory = MemoryBank(capacity=(T-2) // opt.save_freq + 1, max_size=opt.memory_size, policy=opt.memory_policy)
             for t in range(1, T):
                 if t-1 == 0:
                     tmp_mask = masks[0:1]
@@ -332,19 +422,14 @@ def test(testloader, model, criterion, epoch):
 
                 # memorize
                 key, val, _ = model(frame=frames[t-1:t, :, :, :], mask=tmp_mask, num_objects=num_objects)
+                memory.write(key, val, keep=(t-1) % opt.save_freq == 0)
 
                 # segment
-                tmp_key = torch.cat(keys+[key], dim=1)
-                tmp_val = torch.cat(vals+[val], dim=1)
-                logits, ps = model(frame=frames[t:t+1, :, :, :], keys=tmp_key, values=tmp_val, num_objects=num_objects, max_obj=max_obj)
+                logits, ps = model(frame=frames[t:t+1, :, :, :], memory=memory, num_objects=num_objects, max_obj=max_obj)
 
                 out = torch.softmax(logits, dim=1)
                 pred.append(out)
 
-                if (t-1) % opt.save_freq == 0:
-                    keys.append(key)
-                    vals.append(val)
-            
             pred = torch.cat(pred, dim=0)
             pred = pred.detach().cpu().numpy()
             write_mask(pred, info, opt)
@@ -352,7 +437,7 @@ def test(testloader, model, criterion, epoch):
             toc = time.time() - t1
 
             data_time.update(toc, 1)
-           
+
             # plot progress
             bar.suffix  = '({batch}/{size}) Time: {data:.3f}s'.format(
                 batch=batch_idx + 1,
@@ -365,7 +450,4 @@ def test(testloader, model, criterion, epoch):
     return
 
 if __name__ == '__main__':
-    args = parse_args()
-    torch.distributed.init_process_group(backend='nccl', init_method='env://')
-    torch.cuda.set_device(args.local_rank)
-    main(args)
+    main(parse_args())
@@ -20,6 +20,7 @@ ROOT_YT = '/public/home/jm/Data/datasets/YTBVOS'
 ROOT_DAVIS = '/public/home/jm/Data/datasets/DAVIS'
 MAX_TRAINING_OBJ = 6
 MAX_TRAINING_SKIP = 100
+MANIFEST_ROOT = '/public/home/jm/Data/output/stm_output'
 
 def multibatch_collate_fn(batch):
 
@@ -56,14 +57,252 @@ def convert_one_hot(oh, max_obj):
 
     return mask
 
+def convert_label(label, max_obj):
+
+    # convert label maps of size [T x H x W] (torch.uint8) to one hot encoded
+    # masks of size [T x (max_obj+1) x H x W], larger labels have no channel
+    channel = torch.arange(max_obj+1, dtype=label.dtype, device=label.device).view(1, -1, 1, 1)
+
+    return (label.unsqueeze(1) == channel).float()
+
+def count_objects(mask):
+
+    # number of the objects 1, 2, ... (at most MAX_TRAINING_OBJ) present in the first frame
+    # of a one hot mask [T x K x H x W] or a label map [T x H x W]
+    num_obj = 0
+    for i in range(1, MAX_TRAINING_OBJ+1):
+        present = mask[0, i].any() if mask.dim() == 4 else (mask[0] == i).any()
+        if not present:
+            break
+        num_obj += 1
+
+    return num_obj
+
+def batch_count_objects(masks):
+
+    # count_objects of every sample of a one hot batch [N x T x K x H x W]
+    present = masks[:, 0, 1:MAX_TRAINING_OBJ+1].flatten(2).any(dim=2)
+
+    return present.long().cumprod(dim=1).sum(dim=1)
+
+def read_image(path, size=None):
+
+    # with size given, a JPEG is decoded in DCT domain at the smallest 1/2, 1/4 or 1/8 scale
+    # still covering the image fitted to size, Rescale does the final resize
+    img = Image.open(path)
+    if size is not None:
+        factor = cache_scale(img.height, img.width, size)
+        img.draft(img.mode, (int(math.ceil(factor * img.width)), int(math.ceil(factor * img.height))))
+
+    return np.array(img)
+
+def decode_size(transform):
+
+    # size the frames are decoded at for a transform, enlarged by its largest zoom so that
+    # zoomed crops are not upsampled from a reduced frame, None to decode at full resolution
+    size = getattr(transform, 'size', None)
+    if size is None:
+        return None
+    if isinstance(size, int):
+        size = (size, size)
+    zoom = getattr(transform, 'zoom', 1.0)
+
+    return tuple(int(math.ceil(s * zoom)) for s in size)
+
+def build_manifest(imgdir, annodir, videos):
+
+    # frame list, palette, object count, image size and objects present in each frame of every video
+    manifest = {}
+    for vid in videos:
+        frames = [name[:5] for name in os.listdir(os.path.join(annodir, vid))]
+        frames.sort()
+        anno = Image.open(os.path.join(annodir, vid, frames[0]+'.png'))
+        img = Image.open(os.path.join(imgdir, vid, frames[0]+'.jpg'))
+        objects = []
+        for name in frames:
+            ids = np.unique(np.array(Image.open(os.path.join(annodir, vid, name+'.png'))))
+            objects.append(tuple(int(k) for k in ids if k != 0 and k != 255))
+        manifest[vid] = {
+            'frames': frames,
+            'palette': anno.getpalette(),
+            'num_obj': int(np.array(anno).max()), # largest object id of the first annotation
+            'size': (img.height, img.width),
+            'objects': objects,
+        }
+
+    return manifest
+
+def load_manifest(name, imgdir, annodir, videos):
+
+    # the manifest is built once per dataset and split and cached, so that
+    # samples are drawn without listing folders or reading extra files
+    cache_file = os.path.join(MANIFEST_ROOT, 'manifest_{}.pkl'.format(name))
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            manifest = pickle.load(f)
+        if all(vid in manifest and 'objects' in manifest[vid] for vid in videos):
+            return manifest
+
+    manifest = build_manifest(imgdir, annodir, videos)
+
+    if not os.path.exists(MANIFEST_ROOT):
+        os.makedirs(MANIFEST_ROOT)
+    # write then rename, several processes may build the same manifest
+    tmp_file = '{}.{}'.format(cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(manifest, f)
+    os.replace(tmp_file, cache_file)
+    print('==> {}: manifest dumped at {}'.format(name, cache_file))
+
+    return manifest
+
+def cache_scale(h, w, size):
+
+    # largest factor the frame is shrunk by when fitted to the (transposed) input size, never enlarge
+    th, tw = sorted(size)
+    sh, sw = sorted((h, w))
+
+    return min(th / sh, tw / sw, 1.0)
+
+def build_frame_cache(dataset, size):
+
+    """
+    store the frames and label maps of every video of the dataset, resized near the input size,
+    as flat uint8 arrays in '<name>_frames.bin' and '<name>_labels.bin' with an offset index
+    """
+
+    prefix = os.path.join(MANIFEST_ROOT, 'cache_{}'.format(dataset.name))
+    if not os.path.exists(MANIFEST_ROOT):
+        os.makedirs(MANIFEST_ROOT)
+
+    index = {}
+    frame_offset, label_offset = 0, 0
+    with open(prefix + '_frames.bin', 'wb') as ff, open(prefix + '_labels.bin', 'wb') as lf:
+        for vid in dataset.videos:
+            names = dataset.manifest[vid]['frames']
+            h, w = dataset.manifest[vid]['size']
+            factor = cache_scale(h, w, size)
+            height, width = int(round(factor * h)), int(round(factor * w))
+
+            frame, mask = BaseData.read_frames(dataset, vid, names)
+            for img, msk in zip(frame, mask):
+                img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+                msk = cv2.resize(msk, (width, height), interpolation=cv2.INTER_NEAREST)
+                ff.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+                lf.write(np.ascontiguousarray(msk, dtype=np.uint8).tobytes())
+
+            index[vid] = {
+                'frames': {name: i for i, name in enumerate(names)},
+                'shape': (height, width),
+                'offset': (frame_offset, label_offset),
+            }
+            frame_offset += len(names) * height * width * 3
+            label_offset += len(names) * height * width
+
+    with open(prefix + '_index.pkl', 'wb') as f:
+        pickle.dump(index, f)
+    print('==> {}: frame cache dumped at {}'.format(dataset.name, prefix))
+
+class FrameCache(object):
+
+    """
+    reader of the cache written by build_frame_cache, the files are memory-mapped
+    when first read so that each DataLoader worker maps them itself
+    """
+
+    def __init__(self, name):
+        self.prefix = os.path.join(MANIFEST_ROOT, 'cache_{}'.format(name))
+        with open(self.prefix + '_index.pkl', 'rb') as f:
+            self.index = pickle.load(f)
+        self.frames = None
+        self.labels = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['frames'] = None
+        state['labels'] = None
+        return state
+
+    def read(self, vid, names):
+
+        if self.frames is None:
+            # read-only, the pages stay shared with the page cache
+            self.frames = np.memmap(self.prefix + '_frames.bin', dtype=np.uint8, mode='r')
+            self.labels = np.memmap(self.prefix + '_labels.bin', dtype=np.uint8, mode='r')
+
+        entry = self.index[vid]
+        h, w = entry['shape']
+        frame_offset, label_offset = entry['offset']
+
+        frame, mask = [], []
+        for name in names:
+            i = entry['frames'][name]
+            start = frame_offset + i * h * w * 3
+            frame.append(self.frames[start:start + h * w * 3].reshape(h, w, 3))
+            # the datasets clean the label maps in place, so they get a copy
+            start = label_offset + i * h * w
+            mask.append(np.array(self.labels[start:start + h * w]).reshape(h, w))
+
+        return frame, mask
+
 class BaseData(Dataset):
 
+    # the max_skip curriculum is kept in shared memory, so that DataLoader workers
+    # (including persistent ones) read the value set in the main process
+    @property
+    def max_skip(self):
+        return int(self._max_skip[0])
+
+    @max_skip.setter
+    def max_skip(self, max_skip):
+        if '_max_skip' not in self.__dict__:
+            self._max_skip = torch.zeros(1, dtype=torch.long).share_memory_()
+        self._max_skip[0] = max_skip
+
     def increase_max_skip(self):
         pass
 
     def set_max_skip(self):
         pass
 
+    def sample_frames(self, vid):
+
+        # names of the sampled frames and the objects of the first one, training clips
+        # start from a frame with objects, known from the manifest without decoding
+        frames = self.manifest[vid]['frames']
+        objects = self.manifest[vid]['objects']
+        nframes = len(frames)
+
+        if not self.train:
+            return frames, objects[0]
+
+        nsamples = min(self.sampled_frames, nframes)
+        starts = [i for i in range(nframes-nsamples+1) if len(objects[i]) > 0]
+        if len(starts) == 0:
+            starts = list(range(nframes-nsamples+1))
+
+        last_sample = random.choice(starts)
+        first = last_sample
+        sample_frame = [frames[last_sample]]
+        for i in range(1, nsamples):
+            last_sample = random.sample(
+                range(last_sample+1, min(last_sample+self.max_skip+1, nframes-nsamples+i+1)), 
+            1)[0]
+            sample_frame.append(frames[last_sample])
+
+        return sample_frame, objects[first]
+
+    def read_frames(self, vid, names):
+
+        # decode the frames and label maps of a video, reduced near the input size of the transform
+        size = decode_size(self.transform)
+        frame = [read_image(os.path.join(self.imgdir, vid, name+'.jpg'), size) for name in names]
+        mask = [np.array(Image.open(os.path.join(self.annodir, vid, name+'.png'))) for name in names]
+        mask = [msk if msk.shape == img.shape[:2] else
+            cv2.resize(msk, img.shape[1::-1], interpolation=cv2.INTER_NEAREST) for img, msk in zip(frame, mask)]
+
+        return frame, mask
+
 class YoutubeVOS(BaseData):
 
     def __init__(self, train=True, sampled_frames=3, 
@@ -83,6 +322,8 @@ class YoutubeVOS(BaseData):
         self.samples_per_video = samples_per_video
         self.sampled_frames = sampled_frames
         self.videos = list(self.info.keys())
+        self.name = 'VOS_' + split
+        self.manifest = load_manifest(self.name, self.imgdir, self.annodir, self.videos)
         self.length = len(self.videos) * samples_per_video
         self.max_obj = 12
 
@@ -101,62 +342,34 @@ class YoutubeVOS(BaseData):
 
         vid = self.videos[(idx // self.samples_per_video)]
 
-        imgfolder = os.path.join(self.imgdir, vid)
-        annofolder = os.path.join(self.annodir, vid)
-
-        # frames = [name[:5] for name in os.listdir(annofolder) if name not in self.blacklist[vid]]
-        frames = [name[:5] for name in os.listdir(annofolder)]
-        frames.sort()
-        nframes = len(frames)
-
         num_obj = 0
         while num_obj == 0:
-            # outer-loop check the transformed mask is valid
-            while num_obj == 0:
-                # inner-loop ensure the read mask is valid
-                if self.train:
-                    last_sample = -1
-                    sample_frame = []
-                    nsamples = min(self.sampled_frames, nframes)
-                    for i in range(nsamples):
-                        if i == 0:
-                            last_sample = random.sample(range(0, nframes-nsamples+1), 1)[0]
-                        else:
-                            last_sample = random.sample(
-                                range(last_sample+1, min(last_sample+self.max_skip+1, nframes-nsamples+i+1)), 
-                            1)[0]
-                        sample_frame.append(frames[last_sample])
-                else:
-                    sample_frame = frames
+            # the first frame has objects, sampling is only repeated
+            # when the transforms remove all of them
+            sample_frame, objects = self.sample_frames(vid)
+            num_obj = max(objects, default=0)
 
-                frame = [np.array(Image.open(os.path.join(imgfolder, name+'.jpg'))) for name in sample_frame]
-                mask = [np.array(Image.open(os.path.join(annofolder, name+'.png'))) for name in sample_frame]
-                # clear dirty data
-                for msk in mask:
-                    msk[msk==255] = 0
-
-                num_obj = int(mask[0].max())
-
-            mask = [convert_mask(msk, self.max_obj) for msk in mask]
+            frame, mask = self.read_frames(vid, sample_frame)
+            # clear dirty data
+            for msk in mask:
+                msk[msk==255] = 0
+                msk[msk > self.max_obj] = 255
 
             info = {'name': vid}
             info['frame'] = [int(val['frames'][0][:5]) // 5 for idx, val in self.info[vid]['objects'].items()]
             info['frame'].sort()
-            info['palette'] = Image.open(os.path.join(annofolder, frames[0]+'.png')).getpalette()
-            info['size'] = frame[0].shape[:2]
+            info['palette'] = self.manifest[vid]['palette']
+            info['size'] = self.manifest[vid]['size']
 
             if self.transform is None:
                 raise RuntimeError('Lack of proper transformation')
 
             frame, mask = self.transform(frame, mask, False)
+            if self.transform.one_hot:
+                mask = convert_label(mask, MAX_TRAINING_OBJ if self.train else self.max_obj)
 
             if self.train:
-                num_obj = 0
-                for i in range(1, MAX_TRAINING_OBJ+1):
-                    if torch.sum(mask[0, i]) > 0:
-                        num_obj += 1
-                    else:
-                        break
+                num_obj = count_objects(mask)
 
         return frame, mask, num_obj, info
 
@@ -184,6 +397,9 @@ class Davis16(BaseData):
             self.info = db
             self.videos = [info['name'] for info in db if info['set']==targetset]
 
+        self.name = 'DAVIS16_' + targetset
+        self.manifest = load_manifest(self.name, self.imgdir, self.annodir, self.videos)
+
         self.samples_per_video = samples_per_video
         self.sampled_frames = sampled_frames
         self.length = samples_per_video * len(self.videos)
@@ -204,11 +420,7 @@ class Davis16(BaseData):
 
         vid = self.videos[(idx // self.samples_per_video)]
 
-        imgfolder = os.path.join(self.imgdir, vid)
-        annofolder = os.path.join(self.annodir, vid)
-
-        frames = [name[:5] for name in os.listdir(annofolder)]
-        frames.sort()
+        frames = self.manifest[vid]['frames']
         nframes = len(frames)
 
         if self.train:
@@ -226,19 +438,21 @@ class Davis16(BaseData):
         else:
             sample_frame = frames
 
-        frame = [np.array(Image.open(os.path.join(imgfolder, name+'.jpg'))) for name in sample_frame]
-        mask = [np.array(Image.open(os.path.join(annofolder, name+'.png'))) for name in sample_frame]
+        frame, mask = self.read_frames(vid, sample_frame)
         num_obj = max([int(msk.max()) for msk in mask])
-        mask = [convert_mask(msk, self.max_obj) for msk in mask]
+        for msk in mask:
+            msk[msk > self.max_obj] = 255
 
         info = {'name': vid}
-        info['palette'] = Image.open(os.path.join(annofolder, frames[0]+'.png')).getpalette()
-        info['size'] = frame[0].shape[:2]
+        info['palette'] = self.manifest[vid]['palette']
+        info['size'] = self.manifest[vid]['size']
 
         if self.transform is None:
             raise RuntimeError('Lack of proper transformation')
 
         frame, mask = self.transform(frame, mask, False)
+        if self.transform.one_hot:
+            mask = convert_label(mask, MAX_TRAINING_OBJ if self.train else self.max_obj)
 
         return frame, mask, num_obj, info
 
@@ -268,9 +482,10 @@ class Davis17(BaseData):
             self.info = db
             self.videos = [info['name'] for info in db if info['set']==targetset]
 
-            for vid in self.videos:
-                objn = np.array(Image.open(os.path.join(self.annodir, vid, '00000.png'))).max()
-                self.max_obj = max(objn, self.max_obj)
+        self.name = 'DAVIS17_' + targetset
+        self.manifest = load_manifest(self.name, self.imgdir, self.annodir, self.videos)
+        for vid in self.videos:
+            self.max_obj = max(self.manifest[vid]['num_obj'], self.max_obj)
 
         self.samples_per_video = samples_per_video
         self.sampled_frames = sampled_frames
@@ -291,63 +506,29 @@ class Davis17(BaseData):
 
         vid = self.videos[(idx // self.samples_per_video)]
 
-        imgfolder = os.path.join(self.imgdir, vid)
-        annofolder = os.path.join(self.annodir, vid)
+        # the first frame has objects, no decode is wasted on resampling
+        sample_frame, objects = self.sample_frames(vid)
+        num_obj = max(objects, default=0)
 
-        frames = [name[:5] for name in os.listdir(annofolder)]
-        frames.sort()
-        nframes = len(frames)
-
-        num_obj = 0
-        while num_obj == 0:
-
-            if self.train:
-                last_sample = -1
-                sample_frame = []
-
-                nsamples = min(self.sampled_frames, nframes)
-                for i in range(nsamples):
-                    if i == 0:
-                        last_sample = random.sample(range(0, nframes-nsamples+1), 1)[0]
-                    else:
-                        last_sample = random.sample(
-                            range(last_sample+1, min(last_sample+self.max_skip+1, nframes-nsamples+i+1)), 
-                        1)[0]
-                    sample_frame.append(frames[last_sample])
-            else:
-                sample_frame = frames
-
-            frame = [np.array(Image.open(os.path.join(imgfolder, name+'.jpg'))) for name in sample_frame]
-            mask = [np.array(Image.open(os.path.join(annofolder, name+'.png'))) for name in sample_frame]
-            # clear dirty data
-            for msk in mask:
-                msk[msk==255] = 0
-
-            num_obj = mask[0].max()
-
-        # if self.train:
-        #     num_obj = min(num_obj, MAX_TRAINING_OBJ)
-
-        mask = [convert_mask(msk, self.max_obj) for msk in mask]
-        # print(mask[0].shape)
+        frame, mask = self.read_frames(vid, sample_frame)
+        # clear dirty data
+        for msk in mask:
+            msk[msk==255] = 0
+            msk[msk > self.max_obj] = 255
 
         info = {'name': vid}
-        info['palette'] = Image.open(os.path.join(annofolder, frames[0]+'.png')).getpalette()
-        info['size'] = frame[0].shape[:2]
+        info['palette'] = self.manifest[vid]['palette']
+        info['size'] = self.manifest[vid]['size']
 
         if self.transform is None:
             raise RuntimeError('Lack of proper transformation')
 
         frame, mask = self.transform(frame, mask, False)
-        # print(frame.shape, mask.shape)
+        if self.transform.one_hot:
+            mask = convert_label(mask, MAX_TRAINING_OBJ if self.train else self.max_obj)
 
         if self.train:
-            num_obj = 0
-            for i in range(1, MAX_TRAINING_OBJ+1):
-                if torch.sum(mask[0, i]) > 0:
-                    num_obj += 1
-                else:
-                    break
+            num_obj = count_objects(mask)
 
         return frame, mask, num_obj, info
 
@@ -355,6 +536,27 @@ class Davis17(BaseData):
 
         return self.length
 
+class CachedData(object):
+
+    # read frames and label maps from the memory-mapped cache written by build_cache.py
+    # instead of decoding the images, the cache of the dataset split must exist
+    def read_frames(self, vid, names):
+        if '_cache' not in self.__dict__:
+            self._cache = FrameCache(self.name)
+        return self._cache.read(vid, names)
+
+class CachedYoutubeVOS(CachedData, YoutubeVOS):
+    pass
+
+class CachedDavis16(CachedData, Davis16):
+    pass
+
+class CachedDavis17(CachedData, Davis17):
+    pass
+
 DATA_CONTAINER['VOS'] = YoutubeVOS
 DATA_CONTAINER['DAVIS16'] = Davis16
-DATA_CONTAINER['DAVIS17'] = Davis17
\ No newline at end of file
+DATA_CONTAINER['DAVIS17'] = Davis17
+DATA_CONTAINER['VOS_cache'] = CachedYoutubeVOS
+DATA_CONTAINER['DAVIS16_cache'] = CachedDavis16
+DATA_CONTAINER['DAVIS17_cache'] = CachedDavis17
\ No newline at end of file
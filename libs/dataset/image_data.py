@@ -3,7 +3,7 @@ import contextlib
 import io
 import os
 import os.path as osp
-import pickle
+import shutil
 import copy
 import random
 
@@ -12,13 +12,19 @@ from PIL import Image
 from pycocotools import mask as MaskApi
 from pycocotools.coco import COCO
 
+import cv2
 import torch
 from torch.utils.data import Dataset
 
+from .data import read_image, decode_size, convert_label, count_objects
+
 
 COCO_ROOT = '/public/home/jm/Data/datasets/COCO'
 CACHE_ROOT = '/public/home/jm/Data/output/stm_output'
 MAX_TRAINING_OBJ = 6
+# columns of the annotation cache, the annotations of image i are anno_offset[i]:anno_offset[i+1]
+# and the compressed RLE of annotation j is rle[rle_offset[j]:rle_offset[j+1]]
+TABLE_KEYS = ('file_name', 'size', 'anno_offset', 'rle_offset', 'rle')
 
 
 class BaseData(Dataset):
@@ -39,7 +45,6 @@ class COCODataset(BaseData):
     subsets: list
         dataset split name [train2017,val2017]
     """
-    data_items = []
 
     def __init__(self, transform=None, sampled_frames=3, ratio=0.1) -> None:
         r"""
@@ -53,22 +58,18 @@ class COCODataset(BaseData):
         self.train = True
         self.ratio = ratio
 
-        if len(COCODataset.data_items) == 0:
-            self._ensure_cache()
-
-    def _generate_mask_from_anno(self, raw_mask, img_h, img_w):
-        jth_mask_raw = MaskApi.frPyObjects(raw_mask, img_h, img_w)
-        jth_mask = MaskApi.decode(jth_mask_raw)
-        mask_shape = jth_mask.shape
-        if len(mask_shape) == 3:
-            target_mask = np.zeros((mask_shape[0], mask_shape[1]),
-                                   dtype=np.uint8)
-            for iter_chl in range(mask_shape[2]):
-                target_mask = target_mask | jth_mask[:, :, iter_chl]
-        else:
-            target_mask = jth_mask
-        target_mask = target_mask.astype(np.uint8) # 0 or 1
-        return target_mask
+        self.tables = []
+        self._ensure_cache()
+
+    def __getstate__(self):
+        # the memory-mapped tables are mapped again by each worker instead of being pickled
+        state = self.__dict__.copy()
+        state['tables'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._ensure_cache()
 
     def __getitem__(self, item):
         """
@@ -78,51 +79,85 @@ class COCODataset(BaseData):
             annos
             meta (optional)
         """
-        num_obj = 0
-        while num_obj==0:
-            idx = random.sample(range(len(COCODataset.data_items)), 1)[0]
-            record = COCODataset.data_items[item]
-            image_file = record["file_name"]
-            img_h = record["height"]
-            img_w = record["width"]
-            anno = record['annotations']
-            mask_anno = []
-            for obj in anno:
-                raw_mask = obj['segmentation']
-                mask_obj = self._generate_mask_from_anno(raw_mask, img_h, img_w)
-                mask_anno.append(mask_obj)
-            num_obj = len(mask_anno)
-
-        frame = np.array(Image.open(image_file))
+        for table in self.tables:
+            if item < len(table['size']):
+                break
+            item -= len(table['size'])
+
+        image_file = osp.join(table['image_root'], table['file_name'][item].decode())
+        img_h, img_w = [int(v) for v in table['size'][item]]
+        start, end = table['anno_offset'][item:item+2]
+
+        # choose the objects first and decode only those from their compressed RLE
+        chosen = list(range(end - start))
+        if len(chosen) > MAX_TRAINING_OBJ:
+            chosen = random.sample(chosen, MAX_TRAINING_OBJ)
+            chosen.sort()
+        rle_offset, rle = table['rle_offset'], table['rle']
+        obj_masks = MaskApi.decode([
+            {'size': [img_h, img_w], 'counts': rle[rle_offset[start+k]:rle_offset[start+k+1]].tobytes()}
+            for k in chosen
+        ])
+
+        # label map, overlapping pixels belong to the last object
+        mask = np.zeros((img_h, img_w), dtype=np.uint8)
+        for k in range(len(chosen)):
+            mask[obj_masks[:, :, k]==1] = k+1
+
+        frame = read_image(image_file, decode_size(self.transform))
         if len(frame.shape)==2:
             frame = frame[:, :, np.newaxis]
             frame = frame.repeat(3, axis=2)
         assert len(frame.shape) == 3
-        mask = np.stack(mask_anno, axis=2)
-        # add background
-        bg = np.ones(mask.shape[:2]+(1,))
-        bg[np.any(mask==1, axis=2)] = 0
-        mask = np.concatenate((bg, mask), axis=2)
+        if frame.shape[:2] != (img_h, img_w):
+            # the frame is decoded at reduced size
+            mask = cv2.resize(mask, frame.shape[1::-1], interpolation=cv2.INTER_NEAREST)
 
-        frames = [frame.copy() for i in range(self.sampled_frames)]
-        masks = [mask.copy() for i in range(self.sampled_frames)]
+        # the transforms do not write to their inputs, so the pseudo video shares the image
+        frames = [frame] * self.sampled_frames
+        masks = [mask] * self.sampled_frames
 
         if self.transform is None:
             raise RuntimeError('Lack of proper transformation')
         frames, masks = self.transform(frames, masks, True)
+        if self.transform.one_hot:
+            masks = convert_label(masks, MAX_TRAINING_OBJ)
 
+        num_obj = len(chosen)
         if self.train:
-            num_obj = 0
-            for i in range(1, MAX_TRAINING_OBJ+1):
-                if torch.sum(masks[0, i]) > 0:
-                    num_obj += 1
-                else:
-                    break
+            num_obj = count_objects(masks)
 
         return frames, masks, num_obj, None
 
     def __len__(self):
-        return int(self.ratio*len(COCODataset.data_items))
+        return int(self.ratio*sum([len(table['size']) for table in self.tables]))
+
+    def _dump_table(self, records, cache_dir):
+        # flat arrays of the records, written to a temporary folder then renamed
+        # as several processes may build the same cache
+        rles = [obj['segmentation']['counts'] for record in records for obj in record['annotations']]
+        table = {
+            'file_name': np.array([osp.basename(record['file_name']) for record in records], dtype=np.bytes_),
+            'size': np.array([[record['height'], record['width']] for record in records], dtype=np.int32),
+            'anno_offset': np.cumsum([0] + [len(record['annotations']) for record in records]).astype(np.int64),
+            'rle_offset': np.cumsum([0] + [len(counts) for counts in rles]).astype(np.int64),
+            'rle': np.frombuffer(b''.join(rles), dtype=np.uint8),
+        }
+
+        tmp_dir = '{}.{}'.format(cache_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        for key in TABLE_KEYS:
+            np.save(osp.join(tmp_dir, key + '.npy'), table[key])
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            # built by another process
+            shutil.rmtree(tmp_dir)
+
+    def _load_table(self, cache_dir, image_root):
+        table = {key: np.load(osp.join(cache_dir, key + '.npy'), mmap_mode='r') for key in TABLE_KEYS}
+        table['image_root'] = image_root
+        return table
 
     def _ensure_cache(self):
         dataset_root = self.dataset_root
@@ -130,14 +165,9 @@ class COCODataset(BaseData):
         for subset in subsets:
             data_anno_list = []
             image_root = osp.join(dataset_root, "images", subset)
-            cache_file = osp.join(CACHE_ROOT,"coco_mask_{}.pkl".format(subset))
-            # print(cache_file)
-            if osp.exists(cache_file):
-                with open(cache_file, 'rb') as f:
-                    COCODataset.data_items += pickle.load(f)
-                print("==> {}: loaded cache file {}".format(
-                    COCODataset.__name__, cache_file))
-            else:
+            cache_dir = osp.join(CACHE_ROOT,"coco_{}".format(subset))
+            # print(cache_dir)
+            if not osp.exists(cache_dir):
                 anno_file = osp.join(
                     dataset_root,
                     "annotations",
@@ -227,6 +257,12 @@ class COCODataset(BaseData):
                                 ]
                                 if len(segm) == 0:
                                     continue  # ignore this instance
+                                # store the union of the polygons as one compressed RLE
+                                segm = MaskApi.merge(MaskApi.frPyObjects(
+                                    segm, img_dict["height"], img_dict["width"]))
+                            else:
+                                segm = MaskApi.frPyObjects(
+                                    segm, img_dict["height"], img_dict["width"])
                             obj["segmentation"] = segm
                         else:
                             continue
@@ -237,11 +273,8 @@ class COCODataset(BaseData):
                     record["annotations"] = objs
                     data_anno_list.append(record)
 
-                # save internal .json file
-                cache_dir = osp.dirname(cache_file)
-                if not osp.exists(cache_dir):
-                    os.makedirs(cache_dir)
-                with open(cache_file, 'wb') as f:
-                    pickle.dump(data_anno_list, f)
-                print("==> COCO dataset: cache dumped at: {}".format(cache_file))
-                COCODataset.data_items += data_anno_list
+                # save internal annotation table
+                self._dump_table(data_anno_list, cache_dir)
+                print("==> COCO dataset: cache dumped at: {}".format(cache_dir))
+
+            self.tables.append(self._load_table(cache_dir, image_root))
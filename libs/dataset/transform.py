@@ -1,17 +1,16 @@
 import numpy as np
 import torch
+import torch.nn.functional as F
 import math
 import cv2
 
 import random
-import imgaug as ia
-import imgaug.augmenters as iaa
-from imgaug.augmentables.segmaps import SegmentationMapsOnImage
-from .data import convert_mask, convert_one_hot, MAX_TRAINING_OBJ
+from .data import MAX_TRAINING_OBJ, convert_label
 
 class Compose(object):
     """
-    Combine several transformation in a serial manner
+    Combine several transformation in a serial manner,
+    the annotations are uint8 label maps of size [H x W] (255 for pixels of no object)
     """
 
     def __init__(self, transform=[]):
@@ -24,58 +23,6 @@ class Compose(object):
 
         return imgs, annos
 
-class Transpose(object):
-
-    """
-    transpose the image and mask
-    """
-
-    def __call__(self, imgs, annos, use_image):
-
-        H, W, _ = imgs[0].shape
-        if H < W:
-            return imgs, annos
-        else:
-            timgs = [np.transpose(img, [1, 0, 2]) for img in imgs]
-            tannos = [np.transpose(anno, [1, 0, 2]) for anno in annos]
-
-            return timgs, tannos
-
-class RandomAffine(object):
-
-    """
-    Affine Transformation to each frame
-    """
-
-    def __call__(self, imgs, annos, use_image):
-
-        if use_image:
-            seq = iaa.Sequential([
-                iaa.Crop(percent=(0.0, 0.1), keep_size=True),
-                iaa.Affine(scale=(0.9, 1.1), shear=(-15, 15), rotate=(-25, 25))
-            ])
-        else:
-            seq = iaa.Sequential([
-                iaa.Crop(percent=(0.0, 0.1), keep_size=True),
-                iaa.Affine(scale=(0.95, 1.05), shear=(-10, 10), rotate=(-15, 15))
-            ])
-
-            seq = seq.to_deterministic()
-
-        num = len(imgs)
-        for idx in range(1, num):
-            img = imgs[idx]
-            anno = annos[idx]
-            max_obj = anno.shape[2]-1
-
-            anno = convert_one_hot(anno, max_obj)
-            segmap = SegmentationMapsOnImage(anno, shape=img.shape)
-            img_aug, segmap_aug = seq(image=img, segmentation_maps=segmap)
-            imgs[idx] = img_aug
-            annos[idx] = convert_mask(segmap_aug.get_arr(), max_obj)
-
-        return imgs, annos
-
 class AdditiveNoise(object):
     """
     sum additive noise
@@ -112,34 +59,9 @@ class RandomContrast(object):
         return imgs, annos
 
 
-class RandomMirror(object):
-    """
-    Randomly horizontally flip the video volume
-    """
-
-    def __init__(self):
-        pass
-
-    def __call__(self, imgs, annos, use_image):
-
-        v = random.randint(0, 1)
-        if v == 0:
-            return imgs, annos
-
-        sample = imgs[0]
-        h, w = sample.shape[:2]
-
-        for id, img in enumerate(imgs):
-            imgs[id] = img[:, ::-1, :]
-
-        for id, anno in enumerate(annos):
-            annos[id] = anno[:, ::-1, :]
-
-        return imgs, annos
-
 class ToFloat(object):
     """
-    convert value type to float
+    convert value type of images to float, label maps stay uint8
     """
 
     def __init__(self):
@@ -149,9 +71,6 @@ class ToFloat(object):
         for idx, img in enumerate(imgs):
             imgs[idx] = img.astype(dtype=np.float32, copy=True)
 
-        for idx, anno in enumerate(annos):
-            annos[idx] = anno.astype(dtype=np.float32, copy=True)
-
         return imgs, annos
 
 class Rescale(object):
@@ -184,13 +103,185 @@ class Rescale(object):
             imgs[id] = canvas
 
         for id, anno in enumerate(annos):
-            canvas = np.zeros((new_height, new_width, anno.shape[2]), dtype=np.float32)
-            rescaled_anno = cv2.resize(anno, (width, height), cv2.INTER_NEAREST)
-            canvas[pad_t:pad_t + height, pad_l:pad_l + width, :] = rescaled_anno
+            # the padding belongs to no object
+            canvas = np.full((new_height, new_width), 255, dtype=np.uint8)
+            rescaled_anno = cv2.resize(anno, (width, height), interpolation=cv2.INTER_NEAREST)
+            canvas[pad_t:pad_t + height, pad_l:pad_l + width] = rescaled_anno
             annos[id] = canvas
 
         return imgs, annos
 
+class RandomWarp(object):
+
+    """
+    transpose of portrait frames, random crop, scale, shear and rotation of the frames after the first,
+    random mirror and letterbox rescale combined into one affine matrix, each frame is warped once
+    to the output canvas, without augment only the transpose and rescale are applied
+    """
+
+    # largest magnification of the crop (up to 20 percent of a side) and scale
+    max_zoom = 1.1 / 0.8
+
+    def __init__(self, target_size, augment=True):
+        assert isinstance(target_size, (int, tuple, list))
+        if isinstance(target_size, int):
+            self.target_size = (target_size, target_size)
+        else:
+            self.target_size = target_size
+        self.augment = augment
+
+    def sample_affine(self, h, w, use_image):
+
+        if use_image:
+            scale, shear, rotate = (0.9, 1.1), 15, 25
+        else:
+            scale, shear, rotate = (0.95, 1.05), 10, 15
+
+        # crop up to 10 percent of each side and resize back to the frame size
+        top, bottom = [int(round(np.random.uniform(0.0, 0.1) * h)) for _ in range(2)]
+        left, right = [int(round(np.random.uniform(0.0, 0.1) * w)) for _ in range(2)]
+        sx, sy = w / (w - left - right), h / (h - top - bottom)
+        crop = np.array([[sx, 0, -left * sx], [0, sy, -top * sy], [0, 0, 1]])
+
+        # scale, shear and rotation around the frame center
+        s = np.random.uniform(*scale)
+        t = math.tan(math.radians(np.random.uniform(-shear, shear)))
+        r = math.radians(np.random.uniform(-rotate, rotate))
+        center = np.array([[1, 0, w / 2], [0, 1, h / 2], [0, 0, 1]])
+        rot = np.array([[math.cos(r), -math.sin(r), 0], [math.sin(r), math.cos(r), 0], [0, 0, 1]])
+        shr = np.array([[1, t, 0], [0, 1, 0], [0, 0, 1]])
+        scl = np.diag([s, s, 1])
+
+        return center @ rot @ shr @ scl @ np.linalg.inv(center) @ crop
+
+    def __call__(self, imgs, annos, use_image):
+
+        # matrices act on continuous coordinates, pixel (i, j) covers [i, i+1) x [j, j+1)
+        h, w = imgs[0].shape[:2]
+        base = np.eye(3)
+        if h >= w:
+            base = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]])
+            h, w = w, h
+
+        new_height, new_width = self.target_size
+        factor = min(new_height / h, new_width / w)
+        height, width = int(factor * h), int(factor * w)
+        pad_l = (new_width - width) // 2
+        pad_t = (new_height - height) // 2
+        rescale = np.array([[width / w, 0, pad_l], [0, height / h, pad_t], [0, 0, 1]])
+
+        if self.augment and random.randint(0, 1) == 1:
+            rescale = rescale @ np.array([[-1, 0, w], [0, 1, 0], [0, 0, 1]])
+
+        # frames of a video share the affine parameters, images draw their own
+        affine = None
+        for idx in range(len(imgs)):
+            mat = base
+            if self.augment and idx > 0:
+                if affine is None or use_image:
+                    affine = self.sample_affine(h, w, use_image)
+                mat = affine @ mat
+            mat = rescale @ mat
+            # to the pixel center coordinates of cv2
+            mat = mat @ np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+            mat[:2, 2] -= 0.5
+
+            imgs[idx] = cv2.warpAffine(imgs[idx], mat[:2], (new_width, new_height), 
+                flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+            # pixels moved out of the frame are background, the padding belongs to no object
+            anno = cv2.warpAffine(annos[idx], mat[:2], (new_width, new_height), 
+                flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            canvas = np.full((new_height, new_width), 255, dtype=np.uint8)
+            canvas[pad_t:pad_t+height, pad_l:pad_l+width] = anno[pad_t:pad_t+height, pad_l:pad_l+width]
+            annos[idx] = canvas
+
+        return imgs, annos
+
+class BatchAugment(object):
+
+    """
+    augmentation of a collated batch on its device, for the clips of TrainTransform(device_augment=True):
+    frames [N x T x 3 x H x W] and label maps [N x T x H x W] in uint8, infos is None for the images of COCODataset.
+    The random affine of the frames after the first, mirror, contrast, noise and normalization follow RandomWarp,
+    RandomContrast, AdditiveNoise and Normalize, the affine acts on the rescaled canvas.
+    Returns the float frames and one hot masks [N x T x (max_obj+1) x H x W]
+    """
+
+    def __init__(self, max_obj=MAX_TRAINING_OBJ):
+        self.max_obj = max_obj
+        self.mean = torch.FloatTensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        self.std = torch.FloatTensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+    def sample_affine(self, h, w, use_image):
+
+        # the matrices of RandomWarp.sample_affine for each entry of use_image [n]
+        n = use_image.shape[0]
+        device = use_image.device
+        rand = lambda: torch.rand(n, device=device)
+        ones, zeros = torch.ones(n, device=device), torch.zeros(n, device=device)
+
+        def matrix(a, b, c, d, e, f):
+            return torch.stack([a, b, c, d, e, f, zeros, zeros, ones], dim=1).view(n, 3, 3)
+
+        top, bottom = (rand() * 0.1 * h).round(), (rand() * 0.1 * h).round()
+        left, right = (rand() * 0.1 * w).round(), (rand() * 0.1 * w).round()
+        sx, sy = w / (w - left - right), h / (h - top - bottom)
+        crop = matrix(sx, zeros, -left * sx, zeros, sy, -top * sy)
+
+        lower = torch.where(use_image, 0.9 * ones, 0.95 * ones)
+        s = lower + (2 - 2 * lower) * rand()
+        t = torch.tan(torch.deg2rad((2 * rand() - 1) * torch.where(use_image, 15 * ones, 10 * ones)))
+        r = torch.deg2rad((2 * rand() - 1) * torch.where(use_image, 25 * ones, 15 * ones))
+
+        center = matrix(ones, zeros, w / 2 * ones, zeros, ones, h / 2 * ones)
+        uncenter = matrix(ones, zeros, -w / 2 * ones, zeros, ones, -h / 2 * ones)
+        rot = matrix(torch.cos(r), -torch.sin(r), zeros, torch.sin(r), torch.cos(r), zeros)
+        shr = matrix(ones, t, zeros, zeros, ones, zeros)
+        scl = matrix(s, zeros, zeros, zeros, s, zeros)
+
+        return center @ rot @ shr @ scl @ uncenter @ crop
+
+    def __call__(self, frames, masks, infos):
+
+        N, T, C, H, W = frames.shape
+        device = frames.device
+
+        # frames of a video share the affine parameters of its second frame, images draw their own,
+        # the first frame is kept
+        use_image = torch.tensor([info is None for info in infos], device=device)
+        affine = self.sample_affine(H, W, use_image.repeat_interleave(T)).view(N, T, 3, 3)
+        affine = torch.where(use_image.view(N, 1, 1, 1), affine, affine[:, 1:2].expand(-1, T, -1, -1))
+        affine[:, 0] = torch.eye(3, device=device)
+
+        mirror = torch.eye(3, device=device).repeat(N, 1, 1)
+        flip = torch.rand(N, device=device) < 0.5
+        mirror[flip, 0, 0] = -1
+        mirror[flip, 0, 2] = W
+        mat = mirror.unsqueeze(1) @ affine
+
+        # grid_sample reads the output pixels from the inverse mapping in normalized coordinates
+        norm = torch.FloatTensor([[2 / W, 0, -1], [0, 2 / H, -1], [0, 0, 1]]).to(device)
+        theta = norm @ torch.inverse(mat) @ torch.inverse(norm)
+        grid = F.affine_grid(theta.view(N*T, 3, 3)[:, :2], (N*T, C, H, W), align_corners=False)
+
+        imgs = F.grid_sample(frames.view(N*T, C, H, W).float(), grid, 
+            mode='bilinear', padding_mode='zeros', align_corners=False)
+        # the label maps are warped together with a validity channel, the pixels moved in
+        # from outside the canvas belong to no object like the letterbox padding
+        labels = torch.stack([masks.view(N*T, H, W).float(), torch.ones(N*T, H, W, device=device)], dim=1)
+        labels = F.grid_sample(labels, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+        labels = torch.where(labels[:, 1] > 0, labels[:, 0], torch.full_like(labels[:, 0], 255))
+
+        contrast = torch.empty(N, device=device).uniform_(0.97, 1.03).repeat_interleave(T).view(-1, 1, 1, 1)
+        noise = torch.empty(N, device=device).uniform_(-5.0, 5.0).repeat_interleave(T).view(-1, 1, 1, 1)
+        imgs = imgs * contrast + noise
+        imgs = (imgs / 255.0 - self.mean.to(device)) / self.std.to(device)
+
+        labels = convert_label(labels.view(N*T, H, W).to(torch.uint8), self.max_obj)
+
+        return imgs.view(N, T, C, H, W), labels.view(N, T, self.max_obj+1, H, W)
+
 class Stack(object):
 
     """
@@ -213,16 +304,15 @@ class Stack(object):
 class ToTensor(object):
 
     """
-    convert to torch.Tensor
+    convert to torch.Tensor, the label maps are expanded to one-hot by convert_label
     """
 
     def __call__(self, imgs, annos, use_image):
 
         imgs = torch.from_numpy(imgs.copy())
-        annos = torch.from_numpy(annos.astype(np.uint8, copy=True)).float()
+        annos = torch.from_numpy(np.ascontiguousarray(annos))
 
         imgs = imgs.permute(0, 3, 1, 2).contiguous()
-        annos = annos.permute(0, 3, 1, 2).contiguous()
 
         return imgs, annos
 
@@ -247,53 +337,58 @@ class ReverseClip(object):
 
 class SampleObject(object):
 
+    """
+    relabel the objects of the first frame as 1...n, at most num of them are randomly kept,
+    the pixels of other objects are labelled 255
+    """
+
     def __init__(self, num):
         self.num = num
 
     def __call__(self, imgs, annos, use_image):
 
-        max_obj = annos[0].shape[2] - 1
-        num_obj = 0
+        objects = [k for k in np.unique(annos[0]) if k != 0 and k != 255]
 
-        valid = np.sum(annos[0].reshape([-1, 1+max_obj]), axis=0) > 0
-        annos = [anno[:, :, valid] for anno in annos]
+        if len(objects) > self.num:
+            objects = random.sample(objects, self.num)
+            objects.sort()
 
-        num_obj = annos[0].shape[2] - 1
-        # while num_obj < max_obj and np.sum(annos[0][:, :, num_obj+1]) > 0:
-        #     num_obj += 1
+        # objects which are not kept belong to no object (255) and are ignored by the loss
+        lookup = np.full(256, 255, dtype=np.uint8)
+        lookup[0] = 0
+        lookup[objects] = np.arange(1, len(objects)+1)
 
-        if num_obj <= self.num:
-            for idx, anno in enumerate(annos):
-                new_anno = np.zeros(anno.shape[:2]+(self.num+1,))
-                new_anno[:, :, :num_obj+1] = anno
-                annos[idx] = new_anno
-        else:
-            sampled_idx = random.sample(range(1, num_obj+1), self.num)
-            sampled_idx.sort()
-            for idx, anno in enumerate(annos):
-                new_anno = np.zeros(anno.shape[:2]+(self.num+1,))
-                new_anno[:, :, 1:self.num+1] = anno[:, :, sampled_idx]
-                new_anno[:, :, 0] = anno[:, :, 0]
-                annos[idx] = new_anno
+        annos = [lookup[anno] for anno in annos]
 
         return imgs, annos
 
 class TrainTransform(object):
 
-    def __init__(self, size, use_image=False):
-        self.transform = Compose([
-            Transpose(),
-            SampleObject(num=MAX_TRAINING_OBJ),
-            RandomAffine(),
-            ToFloat(),
-            RandomContrast(),
-            AdditiveNoise(),
-            RandomMirror(),
-            Rescale(size),
-            Normalize(),
-            Stack(),
-            ToTensor(),
-        ])
+    def __init__(self, size, use_image=False, device_augment=False):
+        self.size = size
+        # frames are zoomed in up to this factor, by RandomWarp or BatchAugment
+        self.zoom = RandomWarp.max_zoom
+        # with device_augment the clips are only rescaled, returned as uint8 frames and label maps
+        # and augmented by BatchAugment after collate
+        self.one_hot = not device_augment
+        if device_augment:
+            self.transform = Compose([
+                SampleObject(num=MAX_TRAINING_OBJ),
+                RandomWarp(size, augment=False),
+                Stack(),
+                ToTensor(),
+            ])
+        else:
+            self.transform = Compose([
+                SampleObject(num=MAX_TRAINING_OBJ),
+                RandomWarp(size),
+                ToFloat(),
+                RandomContrast(),
+                AdditiveNoise(),
+                Normalize(),
+                Stack(),
+                ToTensor(),
+            ])
 
     def __call__(self, imgs, annos, use_image):
         return self.transform(imgs, annos, use_image)
@@ -302,6 +397,9 @@ class TrainTransform(object):
 class TestTransform(object):
 
     def __init__(self, size):
+        self.size = size
+        self.zoom = 1.0
+        self.one_hot = True
         self.transform = Compose([
             ToFloat(),
             Rescale(size),
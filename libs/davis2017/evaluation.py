@@ -12,17 +12,32 @@ from scipy.optimize import linear_sum_assignment
 
 
 class DAVISEvaluation(object):
-    def __init__(self, davis_root, task, gt_set, sequences='all', codalab=False, version='2017'):
+    def __init__(self, davis_root, task, gt_set, sequences='all', codalab=False, version='2017', cache=False):
         """
         Class to evaluate DAVIS sequences from a certain set and for a certain task
         :param davis_root: Path to the DAVIS folder that contains JPEGImages, Annotations, etc. folders.
         :param task: Task to compute the evaluation, chose between semi-supervised or unsupervised.
         :param gt_set: Set to compute the evaluation
         :param sequences: Sequences to consider for the evaluation, 'all' to use all the sequences in a set.
+        :param cache: Keep the ground truth masks in memory to evaluate several results without reading them again.
         """
         self.davis_root = davis_root
         self.task = task
         self.dataset = DAVIS(root=davis_root, task=task, subset=gt_set, sequences=sequences, codalab=codalab, version=version)
+        self.gt_cache = {} if cache else None
+
+    def _get_gt_masks(self, seq):
+        if self.gt_cache is not None and seq in self.gt_cache:
+            return self.gt_cache[seq]
+        all_gt_masks, all_void_masks, all_masks_id = self.dataset.get_all_masks(seq, True)
+        if self.task == 'semi-supervised':
+            all_gt_masks, all_masks_id = all_gt_masks[:, 1:-1, :, :], all_masks_id[1:-1]
+        if self.gt_cache is not None:
+            if self.task == 'semi-supervised':
+                # void masks are not used by the semi-supervised metrics
+                all_gt_masks, all_void_masks = np.ascontiguousarray(all_gt_masks), None
+            self.gt_cache[seq] = (all_gt_masks, all_void_masks, all_masks_id)
+        return all_gt_masks, all_void_masks, all_masks_id
 
     @staticmethod
     def _evaluate_semisupervised(all_gt_masks, all_res_masks, all_void_masks, metric):
@@ -80,9 +95,7 @@ class DAVISEvaluation(object):
         # Sweep all sequences
         results = Results(root_dir=res_path)
         for seq in tqdm(list(self.dataset.get_sequences())):
-            all_gt_masks, all_void_masks, all_masks_id = self.dataset.get_all_masks(seq, True)
-            if self.task == 'semi-supervised':
-                all_gt_masks, all_masks_id = all_gt_masks[:, 1:-1, :, :], all_masks_id[1:-1]
+            all_gt_masks, all_void_masks, all_masks_id = self._get_gt_masks(seq)
             all_res_masks = results.read_masks(seq, all_masks_id)
             if self.task == 'unsupervised':
                 j_metrics_res, f_metrics_res = self._evaluate_unsupervised(all_gt_masks, all_res_masks, all_void_masks, metric)
@@ -0,0 +1,141 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from .session import VOSSession
+
+
+def _signature(inputs):
+    return tuple(tuple(x.shape[1:]) for x in inputs)
+
+def _split(out, sizes):
+    # split an output along its first dimension, proportionally to the batch size of each call
+    if isinstance(out, (tuple, list)):
+        parts = [_split(o, sizes) for o in out]
+        return [type(out)(p) for p in zip(*parts)]
+    ratio = out.shape[0] // sum(sizes)
+    return torch.split(out, [s * ratio for s in sizes], dim=0)
+
+
+class DynamicBatcher(object):
+    """
+    Group the calls of a function from concurrent threads into batched forwards
+
+    submit(*inputs) queues tensors with a leading batch dimension and blocks until fn has run on
+    them. A worker thread waits until max_batch calls are pending or the oldest one has waited
+    max_wait seconds, concatenates the pending calls whose inputs have the same shapes, runs fn
+    once without gradient and hands every call its slice of the outputs.
+
+    fn: function of tensors returning a tensor or a (nested) tuple of tensors whose first dimension
+        is a multiple of the batch size
+    max_batch: max number of calls batched together
+    max_wait: max seconds a call waits for others to join its batch
+    """
+
+    def __init__(self, fn, max_batch=8, max_wait=0.005):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = []
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, *inputs):
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('the batcher is closed')
+            self.pending.append((time.time(), inputs, future))
+            self.cond.notify()
+        return future.result()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _collect(self):
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if not self.pending:
+                return []
+
+            deadline = self.pending[0][0] + self.max_wait
+            while len(self.pending) < self.max_batch and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            # batch the oldest call with the following ones of the same shapes
+            signature = _signature(self.pending[0][1])
+            calls, rest = [], []
+            for call in self.pending:
+                if len(calls) < self.max_batch and _signature(call[1]) == signature:
+                    calls.append(call)
+                else:
+                    rest.append(call)
+            self.pending = rest
+
+        return calls
+
+    def _run(self):
+        while True:
+            calls = self._collect()
+            if not calls:
+                return
+
+            try:
+                sizes = [inputs[0].shape[0] for _, inputs, _ in calls]
+                inputs = [torch.cat(x, dim=0) for x in zip(*[inputs for _, inputs, _ in calls])]
+                with torch.no_grad():
+                    outputs = self.fn(*inputs)
+                outputs = _split(outputs, sizes)
+            except Exception as e:
+                for _, _, future in calls:
+                    future.set_exception(e)
+                continue
+
+            for (_, _, future), out in zip(calls, outputs):
+                future.set_result(out)
+
+
+class BatchedSession(VOSSession):
+    """
+    VOSSession whose memory and query encoding run in batches shared with the other sessions
+
+    memorizer: DynamicBatcher over STM.memorize of (frame, mask) with the mask cut to num_objects+1 channels
+    encoder: DynamicBatcher over STM.encode_query
+    """
+
+    def __init__(self, memorizer, encoder, *args, **kwargs):
+        self.memorizer = memorizer
+        self.encoder = encoder
+        super(BatchedSession, self).__init__(*args, **kwargs)
+
+    def memorize(self, frame, mask):
+        # sessions with the same number of objects share the memory encoder forward
+        key, val, _ = self.memorizer.submit(frame, mask[:, :self.num_objects+1])
+        return key, val
+
+    def encode_query(self, frame):
+        return self.encoder.submit(frame)
+
+
+def build_batchers(model, max_batch=8, max_wait=0.005):
+    """
+    return the memorize and query encoding batchers of a test phase STM for BatchedSession
+    """
+    memorizer = DynamicBatcher(
+        lambda frame, mask: model(frame=frame, mask=mask, num_objects=mask.shape[1]-1),
+        max_batch=max_batch, max_wait=max_wait)
+    encoder = DynamicBatcher(model.encode_query, max_batch=max_batch, max_wait=max_wait)
+
+    return memorizer, encoder
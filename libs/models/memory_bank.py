@@ -0,0 +1,222 @@
+import torch
+
+EVICTION_POLICY = {}
+
+
+class EvictionPolicy(object):
+    """
+    choose the kept frame to drop when a bounded memory bank is full
+    """
+
+    keep_first = False        # never drop the first memorized (annotated) frame
+    use_attention = False     # requires the readout attention of every segmented frame
+
+    def candidates(self, bank):
+        slots = list(range(bank.size))
+        if self.keep_first and len(slots) > 1:
+            slots = [s for s in slots if bank.stamps[s] != 0]
+        return slots
+
+    def select(self, bank):
+        raise NotImplementedError
+
+
+class FIFOPolicy(EvictionPolicy):
+    """
+    drop the oldest frame
+    """
+
+    def select(self, bank):
+        return min(self.candidates(bank), key=lambda s: bank.stamps[s])
+
+
+class KeepFirstPolicy(FIFOPolicy):
+    """
+    always keep the first annotated frame, drop the oldest of the others
+    """
+
+    keep_first = True
+
+
+class LeastAttendedPolicy(EvictionPolicy):
+    """
+    drop the frame receiving the lowest mean share of the readout attention
+    """
+
+    use_attention = True
+
+    def select(self, bank):
+        slots = self.candidates(bank)
+        reads = bank.reads[slots]
+        score = bank.usage[slots] / reads.clamp(min=1)
+        # frames which have not been read yet are only dropped as a last resort
+        score[reads == 0] = float('inf')
+        return slots[score.argmin().item()]
+
+
+EVICTION_POLICY['fifo'] = FIFOPolicy
+EVICTION_POLICY['keep_first'] = KeepFirstPolicy
+EVICTION_POLICY['least_attended'] = LeastAttendedPolicy
+
+
+class MemoryBank(object):
+    """
+    Preallocated key / value storage of the space-time memory
+
+    keys are stored as [objects x slots x hw x keydim] and values as [objects x slots x hw x valdim],
+    one slot per memorized frame plus a working slot for the latest (not yet kept) frame. Writing a
+    frame copies it into its slot only, and reading returns views over the occupied slots which
+    Memory.forward consumes directly, so no step re-copies the whole memory.
+
+    capacity: number of kept frames to allocate for, the storage grows when it is exceeded
+    max_size: upper bound of kept frames (0 for unlimited), beyond it a frame chosen by policy
+              is overwritten
+    policy: eviction policy name in EVICTION_POLICY or an EvictionPolicy instance
+    """
+
+    def __init__(self, capacity=8, max_size=0, policy='keep_first'):
+        self.max_size = max_size
+        self.capacity = max(capacity, 1)
+        if max_size > 0:
+            self.capacity = min(self.capacity, max_size)
+        self.policy = EVICTION_POLICY[policy]() if isinstance(policy, str) else policy
+        self.reset()
+
+    def reset(self):
+        self.keys = None
+        self.values = None
+        self.num_objects = 0
+        self.size = 0         # number of kept frames
+        self.temp = False     # whether the working slot holds a frame
+        self.count = 0        # number of frames kept so far, including evicted ones
+        self.stamps = []      # insertion order of the frame in each slot
+        self.usage = None     # accumulated attention share of each slot
+        self.reads = None     # number of readouts of each slot
+        # gradient mode: autograd forbids writing into a buffer that an earlier
+        # readout saved for backward, so frames are kept as separate tensors
+        self.key_list = []
+        self.val_list = []
+        self.temp_kv = None
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, key, val, capacity, num_objects):
+        _, hw, keydim = key.shape
+        valdim = val.shape[2]
+        keys = key.new_zeros(num_objects, capacity+1, hw, keydim)
+        values = val.new_zeros(num_objects, capacity+1, hw, valdim)
+        # statistics stay in full precision whatever the precision of the keys
+        usage = key.new_zeros(capacity+1, dtype=torch.float32)
+        reads = key.new_zeros(capacity+1, dtype=torch.long)
+        if self.keys is not None:
+            n = self.size + int(self.temp)
+            keys[:self.num_objects, :n] = self.keys[:, :n]
+            values[:self.num_objects, :n] = self.values[:, :n]
+            usage[:n] = self.usage[:n]
+            reads[:n] = self.reads[:n]
+        self.keys, self.values = keys, values
+        self.usage, self.reads = usage, reads
+        self.capacity = capacity
+
+    def _grow_objects(self, key, val):
+        # objects appearing later than the first frame are backfilled with their
+        # entries of the current frame so that every object reads the same slots
+        num_objects = key.shape[0]
+        old = self.num_objects
+        self._allocate(key, val, self.capacity, num_objects)
+        n = self.size + int(self.temp)
+        if n > 0:
+            self.keys[old:, :n] = key[old:].unsqueeze(1)
+            self.values[old:, :n] = val[old:].unsqueeze(1)
+        self.num_objects = num_objects
+
+    def write(self, key, val, keep=True):
+        """
+        key: [no x hw x keydim], val: [no x hw x valdim] of one memorized frame
+        keep: keep the frame in memory, otherwise it only lives until the next write
+        """
+        if key.requires_grad or val.requires_grad:
+            return self._write_list(key, val, keep)
+
+        if self.keys is None:
+            self.num_objects = key.shape[0]
+            self._allocate(key, val, self.capacity, self.num_objects)
+        elif key.shape[0] > self.num_objects:
+            self._grow_objects(key, val)
+
+        slot = self.size
+        if keep and self.max_size > 0 and self.size == self.max_size:
+            slot = self.policy.select(self)
+        elif keep and self.size == self.capacity:
+            capacity = 2 * self.capacity
+            if self.max_size > 0:
+                capacity = min(capacity, self.max_size)
+            self._allocate(key, val, capacity, self.num_objects)
+
+        no = key.shape[0]
+        self.keys[:no, slot] = key
+        self.values[:no, slot] = val
+        self.usage[slot] = 0
+        self.reads[slot] = 0
+        if keep:
+            if slot == self.size:
+                self.stamps.append(self.count)
+                self.size += 1
+            else:
+                self.stamps[slot] = self.count
+            self.count += 1
+            self.temp = False
+        else:
+            self.temp = True
+
+    def _write_list(self, key, val, keep):
+        if keep:
+            self.key_list.append(key)
+            self.val_list.append(val)
+            self.size += 1
+            self.temp_kv = None
+        else:
+            self.temp_kv = (key, val)
+
+    def read(self, num_objects=None):
+        """
+        return keys [no x (frames*hw) x keydim] and values [no x (frames*hw) x valdim]
+        of all kept frames together with the latest written frame
+        """
+        if self.keys is None:
+            keys = list(self.key_list)
+            vals = list(self.val_list)
+            if self.temp_kv is not None:
+                keys.append(self.temp_kv[0])
+                vals.append(self.temp_kv[1])
+            return torch.cat(keys, dim=1), torch.cat(vals, dim=1)
+
+        no = self.num_objects if num_objects is None else num_objects
+        n = self.size + int(self.temp)
+        _, _, hw, keydim = self.keys.shape
+        valdim = self.values.shape[3]
+        keys = self.keys[:no, :n].view(no, n*hw, keydim)
+        values = self.values[:no, :n].view(no, n*hw, valdim)
+
+        return keys, values
+
+    def update(self, p):
+        """
+        p: [no x (frames*hw) x query_hw] readout attention of the last read, or the
+        (indices, probabilities) pair [no x k x query_hw] of a top-k readout
+        """
+        if self.keys is None or not self.policy.use_attention:
+            return
+
+        n = self.size + int(self.temp)
+        if isinstance(p, tuple):
+            idx, p = p
+            no, _, hw_q = p.shape
+            slot = (idx // self.keys.shape[2]).view(-1)
+            share = self.usage.new_zeros(n).scatter_add_(0, slot, p.detach().float().view(-1))
+        else:
+            no, _, hw_q = p.shape
+            share = p.detach().float().view(no, n, -1, hw_q).sum(dim=(0, 2, 3))
+        self.usage[:n] += share / (no * hw_q)
+        self.reads[:n] += 1
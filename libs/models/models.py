@@ -5,14 +5,19 @@ import math
 
 from torchvision import models
 
-from ..utils.utility import mask_iou
+from ..utils.utility import batch_mask_iou, autocast, checkpoint_call
+from .memory_bank import MemoryBank
 
 def Soft_aggregation(ps, max_obj):
-    
-    num_objects, H, W = ps.shape
-    em = torch.zeros(1, max_obj+1, H, W).to(ps.device)
-    em[0, 0, :, :] =  torch.prod(1-ps, dim=0) # bg prob
-    em[0,1:num_objects+1, :, :] = ps # obj prob
+    # ps: no x H x W of one frame, or n x no x H x W of n frames
+    if ps.dim() == 3:
+        ps = ps.unsqueeze(0)
+    # the aggregation and log odds are kept in fp32 under mixed precision
+    ps = ps.float()
+    n, num_objects, H, W = ps.shape
+    em = torch.zeros(n, max_obj+1, H, W).to(ps.device)
+    em[:, 0, :, :] =  torch.prod(1-ps, dim=1) # bg prob
+    em[:, 1:num_objects+1, :, :] = ps # obj prob
     em = torch.clamp(em, 1e-7, 1-1e-7)
     logit = torch.log((em /(1-em)))
 
@@ -41,13 +46,18 @@ class ResBlock(nn.Module):
          
         return x + r 
 
+def broadcast_add(f, m):
+    # f: features of n frames, m: features of their n x no object masks (frame major)
+    n = f.shape[0]
+    return (f.unsqueeze(1) + m.view(n, -1, *m.shape[1:])).view(m.shape)
+
 class Encoder_M(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(Encoder_M, self).__init__()
         self.conv1_m = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3, bias=False)
         self.conv1_bg = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3, bias=False)
 
-        resnet = models.resnet50(pretrained=True)
+        resnet = models.resnet50(pretrained=pretrained)
         # deeplabv3 = models.segmentation.deeplabv3_resnet50(pretrained=True, progress=True, num_classes=21, aux_loss=None)
         # resnet = deeplabv3.backbone
         self.conv1 = resnet.conv1
@@ -59,6 +69,9 @@ class Encoder_M(nn.Module):
         self.res3 = resnet.layer2 # 1/8, 512
         self.res4 = resnet.layer3 # 1/16, 1024
 
+        # recompute res2-res4 during backward instead of keeping their activations
+        self.grad_checkpoint = False
+
         self.register_buffer('mean', torch.FloatTensor([0.485, 0.456, 0.406]).view(1,3,1,1))
         self.register_buffer('std', torch.FloatTensor([0.229, 0.224, 0.225]).view(1,3,1,1))
 
@@ -68,21 +81,21 @@ class Encoder_M(nn.Module):
         m = torch.unsqueeze(in_m, dim=1).float() # add channel dim
         bg = torch.unsqueeze(in_bg, dim=1).float()
 
-        x = self.conv1(f) + self.conv1_m(m) + self.conv1_bg(bg)
+        x = broadcast_add(self.conv1(f), self.conv1_m(m)) + self.conv1_bg(bg)
         x = self.bn1(x)
         c1 = self.relu(x)   # 1/2, 64
         x = self.maxpool(c1)  # 1/4, 64
-        r2 = self.res2(x)   # 1/4, 256
-        r3 = self.res3(r2) # 1/8, 512
-        r4 = self.res4(r3) # 1/16, 1024
+        r2 = checkpoint_call(self.res2, x, enabled=self.grad_checkpoint)   # 1/4, 256
+        r3 = checkpoint_call(self.res3, r2, enabled=self.grad_checkpoint) # 1/8, 512
+        r4 = checkpoint_call(self.res4, r3, enabled=self.grad_checkpoint) # 1/16, 1024
 
         return r4, r3, r2, c1
  
 class Encoder_Q(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(Encoder_Q, self).__init__()
 
-        resnet = models.resnet50(pretrained=True)
+        resnet = models.resnet50(pretrained=pretrained)
         # deeplabv3 = models.segmentation.deeplabv3_resnet50(pretrained=True, progress=True, num_classes=21, aux_loss=None)
         # resnet = deeplabv3.backbone
         self.conv1 = resnet.conv1
@@ -94,6 +107,9 @@ class Encoder_Q(nn.Module):
         self.res3 = resnet.layer2 # 1/8, 512
         self.res4 = resnet.layer3 # 1/16, 1024
 
+        # recompute res2-res4 during backward instead of keeping their activations
+        self.grad_checkpoint = False
+
         self.register_buffer('mean', torch.FloatTensor([0.485, 0.456, 0.406]).view(1,3,1,1))
         self.register_buffer('std', torch.FloatTensor([0.229, 0.224, 0.225]).view(1,3,1,1))
 
@@ -105,9 +121,9 @@ class Encoder_Q(nn.Module):
         x = self.bn1(x)
         c1 = self.relu(x)   # 1/2, 64
         x = self.maxpool(c1)  # 1/4, 64
-        r2 = self.res2(x)   # 1/4, 256
-        r3 = self.res3(r2) # 1/8, 512
-        r4 = self.res4(r3) # 1/16, 1024
+        r2 = checkpoint_call(self.res2, x, enabled=self.grad_checkpoint)   # 1/4, 256
+        r3 = checkpoint_call(self.res3, r2, enabled=self.grad_checkpoint) # 1/8, 512
+        r4 = checkpoint_call(self.res4, r3, enabled=self.grad_checkpoint) # 1/16, 1024
 
         return r4, r3, r2, c1
 
@@ -119,12 +135,19 @@ class Refine(nn.Module):
         self.ResFS = ResBlock(planes, planes)
         self.ResMM = ResBlock(planes, planes)
 
-    def forward(self, f, pm):
-        s = self.ResFS(self.convFS(f))
-        m = s + F.interpolate(pm, size=s.shape[2:], mode='bilinear', align_corners=False)
+    def skip(self, f):
+        # skip features of the frame, shared by all objects
+        return self.ResFS(self.convFS(f))
+
+    def merge(self, s, pm):
+        # s: skip features of n frames, pm: n x no object features
+        m = broadcast_add(s, F.interpolate(pm, size=s.shape[2:], mode='bilinear', align_corners=False))
         m = self.ResMM(m)
         return m
 
+    def forward(self, f, pm):
+        return self.merge(self.skip(f), pm)
+
 class Decoder(nn.Module):
     def __init__(self, inplane, mdim):
         super(Decoder, self).__init__()
@@ -135,19 +158,28 @@ class Decoder(nn.Module):
 
         self.pred2 = nn.Conv2d(mdim, 2, kernel_size=(3,3), padding=(1,1), stride=1)
 
-    def forward(self, r4, r3, r2, f):
+    def skip(self, r3, r2):
+        return self.RF3.skip(r3), self.RF2.skip(r2)
+
+    def decode(self, r4, s3, s2, f):
         m4 = self.ResMM(self.convFM(r4))
-        m3 = self.RF3(r3, m4) # out: 1/8, 256
-        m2 = self.RF2(r2, m3) # out: 1/4, 256
+        m3 = self.RF3.merge(s3, m4) # out: 1/8, 256
+        m2 = self.RF2.merge(s2, m3) # out: 1/4, 256
 
         p2 = self.pred2(F.relu(m2))
         
         p = F.interpolate(p2, size=f.shape[2:], mode='bilinear', align_corners=False)
         return p
 
+    def forward(self, r4, r3, r2, f):
+        s3, s2 = self.skip(r3, r2)
+        return self.decode(r4, s3, s2, f)
+
 class Memory(nn.Module):
-    def __init__(self):
+    def __init__(self, top_k=0):
         super(Memory, self).__init__()
+        # number of memory entries read by each query pixel, 0 for dense readout
+        self.top_k = top_k
  
     def forward(self, m_in, m_out, q_in, q_out):  # m_in: o,c,t,h,w
         _, _, H, W = q_in.size()
@@ -157,16 +189,34 @@ class Memory(nn.Module):
         qi = q_in.view(-1, C, H*W) 
         p = torch.bmm(m_in, qi) # no x centers x hw
         p = p / math.sqrt(C)
-        p = torch.softmax(p, dim=1) # no x centers x hw
 
-        mo = m_out.permute(0, 2, 1) # no x c x centers 
-        mem = torch.bmm(mo, p) # no x c x hw
+        if 0 < self.top_k < centers:
+            mem, p = self.sparse_readout(p, m_out)
+        else:
+            p = torch.softmax(p, dim=1) # no x centers x hw
+
+            mo = m_out.permute(0, 2, 1) # no x c x centers 
+            mem = torch.bmm(mo, p) # no x c x hw
         mem = mem.view(no, vd, H, W)
 
         mem_out = torch.cat([mem, q_out], dim=1)
 
         return mem_out, p
 
+    def sparse_readout(self, p, m_out):
+        # softmax over the top-k memory entries of each query pixel and aggregate only their values
+        p, idx = torch.topk(p, self.top_k, dim=1) # no x k x hw
+        p = torch.softmax(p, dim=1)
+
+        # one gather of the selected value rows, each read contiguously
+        no, k, hw = idx.shape
+        c = m_out.shape[2]
+        mo = m_out.gather(1, idx.view(no, k*hw, 1).expand(-1, -1, c)).view(no, k, hw, c)
+        mem = (mo * p.unsqueeze(3)).sum(dim=1).permute(0, 2, 1) # no x c x hw
+
+        # the attention is returned sparse as (entry indices, probabilities), both no x k x hw
+        return mem, (idx, p)
+
 class KeyValue(nn.Module):
     # Not using location
     def __init__(self, indim, keydim, valdim):
@@ -180,10 +230,11 @@ class KeyValue(nn.Module):
         return self.Key(x), self.Value(x)
 
 class STM(nn.Module):
-    def __init__(self, keydim, valdim, phase='test', mode='recurrent', iou_threshold=0.5):
+    def __init__(self, keydim, valdim, phase='test', mode='recurrent', iou_threshold=0.5, top_k=0, pretrained=True, precision='fp32', grad_checkpoint=False):
         super(STM, self).__init__()
-        self.Encoder_M = Encoder_M() 
-        self.Encoder_Q = Encoder_Q()
+        # pretrained: initialise the backbones with ImageNet weights, not needed when a checkpoint is loaded
+        self.Encoder_M = Encoder_M(pretrained) 
+        self.Encoder_Q = Encoder_Q(pretrained)
 
         self.keydim = keydim
         self.valdim = valdim
@@ -192,14 +243,23 @@ class STM(nn.Module):
         self.KV_Q_r4 = KeyValue(1024, keydim=keydim, valdim=valdim)
         # self.Routine = DynamicRoutine(channel, iters, centers)
 
-        self.Memory = Memory()
+        self.Memory = Memory(top_k)
         self.Decoder = Decoder(2*valdim, 256)
         self.phase = phase
         self.mode = mode
         self.iou_threshold = iou_threshold
+        # mixed precision of the forward: 'fp32', 'bf16' or 'fp16'
+        self.precision = precision
+        # activation checkpointing of the encoder stages and the decoder in training
+        self.set_grad_checkpoint(grad_checkpoint)
 
         assert self.phase in ['train', 'test']
 
+    def set_grad_checkpoint(self, enabled):
+        self.grad_checkpoint = enabled
+        self.Encoder_M.grad_checkpoint = enabled
+        self.Encoder_Q.grad_checkpoint = enabled
+
     def load_param(self, weight):
 
         s = self.state_dict()
@@ -219,118 +279,119 @@ class STM(nn.Module):
         self.load_state_dict(s)
 
     def memorize(self, frame, masks, num_objects): 
-        # memorize a frame 
+        # memorize a frame, or a batch of n frames with num_objects objects each (frame major outputs)
         # maskb = prob[:, :num_objects, :, :]
         # make batch arg list
-        frame_batch = []
-        mask_batch = []
-        bg_batch = []
-        # print('\n')
-        # print(num_objects)
-        try:
-            for o in range(1, num_objects+1): # 1 - no
-                frame_batch.append(frame)
-                mask_batch.append(masks[:,o])
-
-            for o in range(1, num_objects+1):
-                bg_batch.append(torch.clamp(1.0 - masks[:, o], min=0.0, max=1.0))
-
-            # make Batch
-            frame_batch = torch.cat(frame_batch, dim=0)
-            mask_batch = torch.cat(mask_batch, dim=0)
-            bg_batch = torch.cat(bg_batch, dim=0)
-        except RuntimeError as re:
-            print(re)
-            print(num_objects)
-            raise re
-
-        r4, _, _, _ = self.Encoder_M(frame_batch, mask_batch, bg_batch) # no, c, h, w
+        # the frame is encoded once and shared by all objects, so it is not repeated
+        _, _, H, W = masks.shape
+        mask_batch = masks[:, 1:num_objects+1].reshape(-1, H, W)
+        bg_batch = torch.clamp(1.0 - mask_batch, min=0.0, max=1.0)
+
+        r4, _, _, _ = self.Encoder_M(frame, mask_batch, bg_batch) # no, c, h, w
         _, c, h, w = r4.size()
         memfeat = r4
         # memfeat = self.Routine(memfeat, maskb)
         # memfeat = memfeat.view(-1, c)
         k4, v4 = self.KV_M_r4(memfeat)
-        k4 = k4.permute(0, 2, 3, 1).contiguous().view(num_objects, -1, self.keydim)
-        v4 = v4.permute(0, 2, 3, 1).contiguous().view(num_objects, -1, self.valdim)
+        k4 = k4.permute(0, 2, 3, 1).contiguous().view(-1, h*w, self.keydim)
+        v4 = v4.permute(0, 2, 3, 1).contiguous().view(-1, h*w, self.valdim)
         
         return k4, v4, r4
 
-    def segment(self, frame, keys, values, num_objects, max_obj): 
-        # segment one input frame
+    def encode_query(self, frame):
+        # encode the mask independent features of a batch of query frames
+        with autocast(self.precision, frame.device.type):
+            return self._encode_query(frame)
 
+    def _encode_query(self, frame):
         r4, r3, r2, _ = self.Encoder_Q(frame)
         n, c, h, w = r4.size()
         # r4 = r4.permute(0, 2, 3, 1).contiguous().view(-1, c)
-        k4, v4 = self.KV_Q_r4(r4)   # 1, dim, H/16, W/16
+        k4, v4 = checkpoint_call(self.KV_Q_r4, r4, enabled=self.grad_checkpoint)   # n, dim, H/16, W/16
         # k4 = k4.view(n, self.keydim, -1).permute(0, 2, 1)
         # v4 = v4.view(n, self.valdim, -1).permute(0, 2, 1)
-
-        # expand to ---  no, c, h, w
-        k4e, v4e = k4.expand(num_objects,-1,-1,-1), v4.expand(num_objects,-1,-1,-1) 
-        r3e, r2e = r3.expand(num_objects,-1,-1,-1), r2.expand(num_objects,-1,-1,-1)
-
-        m4, _ = self.Memory(keys, values, k4e, v4e)
-        logit = self.Decoder(m4, r3e, r2e, frame)
-        ps = F.softmax(logit, dim=1)[:, 1] # no, h, w  
+        # decoder skip features, shared by all objects
+        s3, s2 = checkpoint_call(self.Decoder.skip, r3, r2, enabled=self.grad_checkpoint)
+
+        return k4, v4, s3, s2
+
+    def segment(self, frame, keys, values, num_objects, max_obj, memory=None, query=None, valid=None): 
+        # segment one input frame, or a batch of n frames with num_objects objects each (frame major keys)
+        # valid: n x num_objects mask of the object slots, padded slots are left out of the aggregation
+        if memory is not None:
+            keys, values = memory.read()
+
+        # query: features of the frame precomputed by encode_query
+        if query is None:
+            query = self.encode_query(frame)
+        k4, v4, s3, s2 = query
+
+        # expand to ---  n x no, c, h, w
+        k4e = k4.unsqueeze(1).expand(-1, num_objects, -1, -1, -1).reshape(-1, *k4.shape[1:])
+        v4e = v4.unsqueeze(1).expand(-1, num_objects, -1, -1, -1).reshape(-1, *v4.shape[1:])
+
+        m4, p = self.Memory(keys, values, k4e, v4e)
+        if memory is not None:
+            memory.update(p)
+        logit = checkpoint_call(self.Decoder.decode, m4, s3, s2, frame, enabled=self.grad_checkpoint)
+        ps = F.softmax(logit, dim=1)[:, 1] # n x no, h, w  
         # ps = torch.sigmoid(logit)[:, 1]
         #ps = indipendant possibility to belong to each object
-        logit = Soft_aggregation(ps, max_obj) # 1, K, H, W
+        ps = ps.view(-1, num_objects, *ps.shape[1:])
+        if valid is not None:
+            ps = ps * valid.view(*valid.shape, 1, 1)
+        logit = Soft_aggregation(ps, max_obj) # n, K, H, W
+        ps = ps.view(-1, *ps.shape[2:])
 
         return logit, ps
 
-    def forward(self, frame, mask=None, keys=None, values=None, num_objects=None, max_obj=None):
+    def forward(self, frame, mask=None, keys=None, values=None, num_objects=None, max_obj=None, memory=None, query=None):
+        # autocast inside the forward so that it also holds in nn.DataParallel replicas
+        with autocast(self.precision, frame.device.type):
+            return self._forward(frame, mask, keys, values, num_objects, max_obj, memory, query)
+
+    def _forward(self, frame, mask=None, keys=None, values=None, num_objects=None, max_obj=None, memory=None, query=None):
 
         if self.phase == 'test':
             if mask is not None: # keys
                 return self.memorize(frame, mask, num_objects)
             else:
-                return self.segment(frame, keys, values, num_objects, max_obj)
+                return self.segment(frame, keys, values, num_objects, max_obj, memory=memory, query=query)
         elif self.phase == 'train':
 
             N, T, C, H, W = frame.size()
             max_obj = mask.shape[2]-1
 
-            total_loss = 0.0
+            # all clips are run together with max_obj object slots each, the slots beyond
+            # the num_objects of a clip are padding and left out of the aggregation
+            valid = (torch.arange(max_obj, device=num_objects.device).view(1, -1) < num_objects.view(-1, 1)).float()
+
+            memory = MemoryBank(capacity=T-1)
             batch_out = []
-            for idx in range(N):
-
-                num_object = num_objects[idx].item()
-
-                batch_keys = []
-                batch_vals = []
-                tmp_out = []
-                for t in range(1, T):
-                    # memorize
-                    if t-1 == 0 or self.mode == 'mask':
-                        tmp_mask = mask[idx, t-1:t]
-                    elif self.mode == 'recurrent':
-                        tmp_mask = out
-                    else:
-                        pred_mask = out[0, 1:num_object+1]
-                        iou = mask_iou(pred_mask, mask[idx, t-1, 1:num_object+1])
-
-                        if iou > self.iou_threshold:
-                            tmp_mask = out
-                        else:
-                            tmp_mask = mask[idx, t-1:t]
-
-                    key, val, _ = self.memorize(frame=frame[idx, t-1:t], masks=tmp_mask, 
-                        num_objects=num_object)
-
-                    batch_keys.append(key)
-                    batch_vals.append(val)
-                    # segment
-                    tmp_key = torch.cat(batch_keys, dim=1)
-                    tmp_val = torch.cat(batch_vals, dim=1)
-                    logits, ps = self.segment(frame=frame[idx, t:t+1], keys=tmp_key, values=tmp_val, 
-                        num_objects=num_object, max_obj=max_obj)
-
-                    out = torch.softmax(logits, dim=1)
-                    tmp_out.append(out)
-                
-                batch_out.append(torch.cat(tmp_out, dim=0))
-
-            batch_out = torch.stack(batch_out, dim=0) # B, T, No, H, W
+            for t in range(1, T):
+                # memorize
+                if t-1 == 0 or self.mode == 'mask':
+                    tmp_mask = mask[:, t-1]
+                elif self.mode == 'recurrent':
+                    tmp_mask = out
+                else:
+                    iou = batch_mask_iou(out[:, 1:], mask[:, t-1, 1:], valid)
+                    keep = (iou > self.iou_threshold).view(N, 1, 1, 1)
+                    tmp_mask = torch.where(keep, out, mask[:, t-1])
+
+                key, val, _ = self.memorize(frame=frame[:, t-1], masks=tmp_mask, 
+                    num_objects=max_obj)
+
+                memory.write(key, val)
+                # segment
+                tmp_key, tmp_val = memory.read()
+                logits, ps = self.segment(frame=frame[:, t], keys=tmp_key, values=tmp_val, 
+                    num_objects=max_obj, max_obj=max_obj, valid=valid)
+
+                out = torch.softmax(logits, dim=1)
+                batch_out.append(out)
+
+            batch_out = torch.stack(batch_out, dim=1) # B, T-1, No, H, W
 
             return batch_out
 
@@ -0,0 +1,102 @@
+import torch
+
+from .memory_bank import MemoryBank
+
+
+def num_objects_in_mask(mask):
+    # number of object channels up to the last one present in a one-hot mask [1 x (max_obj+1) x H x W]
+    present = torch.nonzero(mask[0, 1:].flatten(1).max(dim=1)[0] > 0)
+    return int(present.max().item()) + 1 if len(present) > 0 else 0
+
+
+class VOSSession(object):
+    """
+    Streaming segmentation of one video
+
+    The session is created with the first frame and its mask, then each following frame is fed
+    through step() which returns its predicted mask. Frames are returned as background until a
+    mask with an object is given. The memory of the video lives in the session,
+    so a single loaded STM (plain, cycle or fusion, in test phase) can serve many sessions and
+    frames never need to be decoded ahead of time.
+
+    model: STM in test phase
+    frame: [1 x 3 x H x W] first frame
+    mask: [1 x (max_obj+1) x H x W] one-hot mask of the first frame
+    num_objects: number of objects, counted from the mask if not given
+    save_freq: every save_freq-th frame is kept in memory
+    memory_size, policy: see MemoryBank
+    """
+
+    def __init__(self, model, frame, mask, num_objects=None, save_freq=5, memory_size=0, policy='keep_first'):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.save_freq = save_freq
+        self.max_obj = mask.shape[1] - 1
+        self.memory = MemoryBank(capacity=8, max_size=memory_size, policy=policy)
+
+        self.num_objects = num_objects_in_mask(mask)
+        if num_objects is not None:
+            self.num_objects = max(self.num_objects, num_objects)
+
+        # the last frame and the mask to memorize it with on the next step
+        self.frame = frame.to(self.device)
+        self.mask = mask.to(self.device)
+        self.index = 0
+
+    def __len__(self):
+        return self.index + 1
+
+    def step(self, frame, mask=None):
+        """
+        segment the next frame
+
+        frame: [1 x 3 x H x W]
+        mask: optional one-hot annotation of the frame. It replaces the prediction in memory, and
+              objects appearing in it are tracked from the next frame on
+        return the soft mask [1 x (max_obj+1) x H x W] predicted for the frame
+        """
+        frame = frame.to(self.device)
+
+        if self.num_objects == 0:
+            # nothing to track until a mask brings in the first object
+            out = self.background(frame)
+        else:
+            with torch.no_grad():
+                # memorize, the first memorized frame is always kept
+                keep = self.index % self.save_freq == 0 or len(self.memory) == 0
+                key, val = self.memorize(self.frame, self.mask)
+                self.memory.write(key, val, keep=keep)
+
+                # segment
+                logits, _ = self.model(frame=frame, memory=self.memory, query=self.encode_query(frame),
+                    num_objects=self.num_objects, max_obj=self.max_obj)
+                out = torch.softmax(logits, dim=1)
+
+        self.frame = frame
+        self.mask = out
+        if mask is not None:
+            self.mask = mask.to(self.device)
+            self.num_objects = max(self.num_objects, num_objects_in_mask(self.mask))
+        self.index += 1
+
+        return out
+
+    def background(self, frame):
+        # all background soft mask of a frame
+        out = frame.new_zeros(1, self.max_obj+1, *frame.shape[2:])
+        out[:, 0] = 1
+        return out
+
+    def memorize(self, frame, mask):
+        key, val, _ = self.model(frame=frame, mask=mask, num_objects=self.num_objects)
+        return key, val
+
+    def encode_query(self, frame):
+        # the query features are computed by STM.segment itself
+        return None
+
+    def close(self):
+        # release the memory of the video
+        self.memory.reset()
+        self.frame = None
+        self.mask = None
@@ -1,7 +1,7 @@
 import math
 import torch
 
-from .utility import mask_iou
+from .utility import mask_iou, batch_mask_iou
 
 def binary_entropy_loss(pred, target, num_object, eps=0.001):
 
@@ -44,7 +44,40 @@ def mask_iou_loss(pred, mask, num_object):
     loss = loss / N
     return loss
 
+def batch_cross_entropy_loss(pred, mask, num_objects, bootstrap=0.4):
 
+    # pred: [N x T x K x H x W]
+    # mask: [N x T x K x H x W] one-hot encoded
+    # num_objects: [N] objects of each sample, the channels beyond are padding
+    # mean of cross_entropy_loss over the samples and frames
+    N, T, K, H, W = mask.shape
 
+    channel = torch.arange(K, device=mask.device).view(1, K)
+    valid = (channel <= num_objects.view(-1, 1)).to(pred.dtype).view(N, 1, K, 1, 1)
 
+    loss = torch.sum(-1 * torch.log(pred) * mask * valid, dim=2).view(N, T, -1)
 
+    # bootstrap, only the hardest pixels are selected
+    num = int(H * W * bootstrap)
+    mloss, _ = torch.topk(loss, num, dim=-1, sorted=False)
+    loss = torch.mean(mloss)
+
+    return loss
+
+def batch_mask_iou_loss(pred, mask, num_objects):
+
+    # pred: [N x T x K x H x W]
+    # mask: [N x T x K x H x W] one-hot encoded
+    # num_objects: [N] objects of each sample
+    # mean of mask_iou_loss over the samples and frames
+    N, T, K, H, W = mask.shape
+
+    start = (num_objects != K).long().view(-1, 1)
+    channel = torch.arange(K, device=mask.device).view(1, K)
+    valid = (channel >= start) & (channel < num_objects.view(-1, 1) + start)
+    valid = valid.to(pred.dtype).unsqueeze(1).expand(-1, T, -1).reshape(N*T, K)
+
+    iou = batch_mask_iou(pred.reshape(N*T, K, H, W), mask.reshape(N*T, K, H, W), valid)
+    loss = torch.mean(1.0 - iou)
+
+    return loss
@@ -2,6 +2,8 @@ import numpy as np
 import math
 
 import torch
+from torch.utils.checkpoint import checkpoint
+from contextlib import nullcontext
 import os
 import shutil
 import cv2
@@ -16,11 +18,16 @@ from ..dataset.data import ROOT_DAVIS
 from libs.davis2017.evaluation import DAVISEvaluation
 
 
-def davis2017_eval(results_path, davis_path=ROOT_DAVIS, task='semi-supervised', set='val', version='2017'):
+def davis2017_eval(results_path, davis_path=ROOT_DAVIS, task='semi-supervised', set='val', version='2017', dataset_eval=None, return_table=False):
+    """
+    dataset_eval: DAVISEvaluation to reuse (e.g. with cached ground truth), created from the other arguments if not given
+    return_table: return the global results table instead of the J&F mean
+    """
     time_start = time()
     print(f'Evaluating sequences for the {task} task...')
     # Create dataset and evaluate
-    dataset_eval = DAVISEvaluation(davis_root=davis_path, task=task, gt_set=set, version=version)
+    if dataset_eval is None:
+        dataset_eval = DAVISEvaluation(davis_root=davis_path, task=task, gt_set=set, version=version)
     metrics_res = dataset_eval.evaluate(results_path)
     J, F = metrics_res['J'], metrics_res['F']
     
@@ -59,6 +66,8 @@ def davis2017_eval(results_path, davis_path=ROOT_DAVIS, task='semi-supervised',
     total_time = time() - time_start
     sys.stdout.write('\nTotal time:' + str(total_time))
     
+    if return_table:
+        return table_g
     return final_mean
 
 def save_checkpoint(state, epoch, is_best, checkpoint='checkpoint', filename='checkpoint', freq=1):
@@ -151,6 +160,51 @@ def mask_iou(pred, target):
 
     return iou
 
+def batch_mask_iou(pred, target, valid):
+
+    """
+    mask_iou of each sample over its own objects
+    param: pred of size [B x N x H x W]
+    param: target of size [B x N x H x W]
+    param: valid of size [B x N], 1 for the objects of the sample and 0 for padded slots
+    """
+
+    assert len(pred.shape) == 4 and pred.shape == target.shape
+
+    inter = torch.min(pred, target).sum(3).sum(2)
+    union = torch.max(pred, target).sum(3).sum(2)
+
+    iou = torch.where(valid > 0, inter / union, torch.zeros_like(inter))
+    iou = torch.sum(iou, dim=1) / torch.sum(valid, dim=1)
+
+    return iou
+
+PRECISION = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def autocast(precision, device_type):
+
+    """
+    mixed precision context of OPTION.precision ('fp32', 'bf16' or 'fp16') on device_type ('cuda' or 'cpu')
+    """
+
+    dtype = PRECISION[precision]
+    if dtype is None:
+        # full precision runs do not enter autocast at all
+        return nullcontext()
+
+    return torch.autocast(device_type, dtype=dtype)
+
+def checkpoint_call(fn, *args, enabled=False):
+
+    """
+    call fn, with enabled its activations are not kept for backward but recomputed
+    """
+
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(fn, *args, use_reentrant=False)
+
+    return fn(*args)
+
 def adjust_learning_rate(optimizer, epoch, opt):
 
     if epoch in opt.milestone:
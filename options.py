@@ -12,11 +12,17 @@ OPTION.max_skip = [5, 3]         # max skip time length while trianing
 OPTION.samples_per_video = 2    # sample numbers per video
 OPTION.with_coco = True
 OPTION.coco_ratio = 0.01
+OPTION.device_augment = False   # workers only rescale the clips, the augmentation runs batched on the training device
 
 # ----------------------------------------- model configuration ---------------------------------------------
 OPTION.keydim = 128
 OPTION.valdim = 512
 OPTION.save_freq = 5
+OPTION.memory_size = 0             # max number of memorized frames while testing (0 for unlimited)
+OPTION.memory_policy = 'keep_first' # 'fifo', 'keep_first' or 'least_attended' eviction when memory is full
+OPTION.top_k = 0                   # memory entries read by each query pixel (0 for dense readout)
+OPTION.lookahead = 1               # number of upcoming frames whose query features are encoded in one batch while testing
+OPTION.precision = 'fp32'          # 'fp32', 'bf16' or 'fp16' (mixed precision with autocast, fp16 training uses loss scaling)
 OPTION.epochs_per_increment = 5
 
 OPTION.backbone = 'resnet34' # 'resnet34' or 'resnet50'
@@ -25,8 +31,10 @@ OPTION.fusion_type = 'se' # 'se' or 'add'
 
 # ---------------------------------------- training configuration -------------------------------------------
 OPTION.epochs = 130
+OPTION.seed = 0                    # random seed, offset by the rank in distributed training
 OPTION.train_batch = 8
 OPTION.workers = 8
+OPTION.prefetch_factor = 4         # batches loaded in advance by each worker
 OPTION.learning_rate = 0.00001
 OPTION.gamma = 0.1
 OPTION.momentum = (0.9, 0.999)
@@ -37,6 +45,7 @@ OPTION.milestone = []              # epochs to degrades the learning rate
 OPTION.loss = 'both'               # 'ce' or 'iou' or 'both'
 OPTION.mode = 'recurrent'          # 'mask' or 'recurrent' or 'threshold'
 OPTION.iou_threshold = 0.65        # used only for 'threshold' training
+OPTION.checkpoint_activations = False # recompute the encoder stages and the decoder during backward to train longer clips / bigger batches
 OPTION.save_model_freq = 5         # frequence for saving model
 OPTION.correction_iter_times = 10
 OPTION.correction_lr = 150
@@ -0,0 +1,256 @@
+from libs.dataset.data import convert_label
+from libs.dataset.transform import TestTransform
+from libs.models.batching import BatchedSession, build_batchers
+
+import torch
+
+import numpy as np
+import cv2
+import io
+import json
+import base64
+import uuid
+import time
+import threading
+import argparse
+from PIL import Image
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from options import OPTION as opt
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Serving Mask Segmentation')
+    parser.add_argument('--checkpoint', default='', type=str, help='checkpoint to serve')
+    parser.add_argument('--model', default='stm', type=str, choices=['stm', 'cycle', 'fusion'], help='model variant of the checkpoint')
+    parser.add_argument('--gpu', default='0', type=str, help='set gpu id to run the network')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='address to listen on')
+    parser.add_argument('--port', default=8000, type=int, help='port to listen on')
+    parser.add_argument('--max-object', default=10, type=int, help='max number of objects of a session')
+    parser.add_argument('--max-batch', default=8, type=int, help='max number of frames encoded in one batch')
+    parser.add_argument('--max-wait', default=5, type=float, help='max milliseconds a frame waits for others to batch with')
+    parser.add_argument('--max-session', default=64, type=int, help='max number of open sessions, 0 for unlimited')
+    parser.add_argument('--session-timeout', default=600, type=float, help='seconds after which an idle session is closed')
+    return parser.parse_args()
+
+def build_model(name, pretrained=True):
+    if name == 'fusion':
+        from libs.models.fusion_models import STM
+        return STM(opt, pretrained=pretrained)
+    elif name == 'cycle':
+        from libs.models.cycle_models import STM
+    else:
+        from libs.models.models import STM
+    return STM(opt.keydim, opt.valdim, top_k=opt.top_k, pretrained=pretrained, precision=opt.precision)
+
+def decode_frame(data):
+    return np.array(Image.open(io.BytesIO(base64.b64decode(data))).convert('RGB'))
+
+def decode_mask(data):
+    # indexed png to label map and palette
+    im = Image.open(io.BytesIO(base64.b64decode(data)))
+    if im.mode not in ['P', 'L']:
+        im = im.convert('L')
+    return np.array(im), im.getpalette()
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """
+    HTTP inference server, each request is handled in its own thread
+
+    POST /sessions          {"frame": <b64 image>, "mask": <b64 indexed png>} -> {"session": <id>}
+    POST /sessions/<id>     {"frame": <b64 image>[, "mask": <b64 indexed png>]} -> {"mask": <b64 indexed png>}
+    DELETE /sessions/<id>   close the session
+
+    Frames of one session are segmented one at a time, and sessions idle for longer than the
+    timeout are closed to release their memory.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, model, device, args):
+        HTTPServer.__init__(self, address, Handler)
+        self.model = model
+        self.device = device
+        self.max_obj = args.max_object
+        self.transform = TestTransform(size=opt.input_size)
+        self.memorizer, self.encoder = build_batchers(model, max_batch=args.max_batch, max_wait=args.max_wait / 1000.0)
+        self.max_session = args.max_session
+        self.timeout = args.session_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def preprocess(self, frame, mask=None):
+        h, w = frame.shape[:2]
+        if mask is None:
+            anno = np.zeros((h, w), dtype=np.uint8)
+        else:
+            anno = cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
+            anno[anno > self.max_obj] = 0
+        frames, annos = self.transform([frame], [anno], False)
+        annos = convert_label(annos.to(self.device), self.max_obj)
+        return frames.to(self.device), (annos if mask is not None else None)
+
+    def postprocess(self, out, size, palette):
+        # undo the letterbox of TestTransform and return the label map as an indexed png
+        h, w = size
+        th, tw = out.shape[2:]
+        factor = min(th / h, tw / w)
+        sh, sw = int(factor*h), int(factor*w)
+        pad_l = (tw - sw) // 2
+        pad_t = (th - sh) // 2
+
+        m = out[0, :, pad_t:pad_t + sh, pad_l:pad_l + sw].cpu().numpy().transpose((1, 2, 0))
+        m = cv2.resize(m, (w, h), interpolation=cv2.INTER_NEAREST)
+        m = m.argmax(axis=2).astype(np.uint8)
+
+        im = Image.fromarray(m).convert('P')
+        if palette is not None:
+            im.putpalette(palette)
+        buf = io.BytesIO()
+        im.save(buf, format='PNG')
+        return base64.b64encode(buf.getvalue()).decode('ascii')
+
+    def expire(self):
+        # close the sessions idle for longer than the timeout
+        now = time.time()
+        with self.lock:
+            stale = [sid for sid, session in self.sessions.items() if now - session.last_used > self.timeout]
+            stale = [self.sessions.pop(sid) for sid in stale]
+        for session in stale:
+            self.release(session)
+
+    def release(self, session):
+        # wait for a running step of the session before freeing its memory
+        with session.lock:
+            session.closed = True
+            session.close()
+
+    def create(self, request):
+        self.expire()
+        with self.lock:
+            if self.max_session > 0 and len(self.sessions) >= self.max_session:
+                raise RuntimeError('too many open sessions')
+        mask, palette = decode_mask(request['mask'])
+        frame, mask = self.preprocess(decode_frame(request['frame']), mask)
+        session = BatchedSession(self.memorizer, self.encoder, self.model, frame, mask,
+            save_freq=opt.save_freq, memory_size=opt.memory_size, policy=opt.memory_policy)
+        session.palette = palette
+        session.lock = threading.Lock()
+        session.closed = False
+        session.last_used = time.time()
+
+        sid = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[sid] = session
+        return {'session': sid}
+
+    def step(self, sid, request):
+        self.expire()
+        with self.lock:
+            session = self.sessions[sid]
+            session.last_used = time.time()
+        frame = decode_frame(request['frame'])
+        mask = decode_mask(request['mask'])[0] if 'mask' in request else None
+        size = frame.shape[:2]
+        frame, mask = self.preprocess(frame, mask)
+        # concurrent requests of the same session would interleave the writes to its memory
+        with session.lock:
+            if session.closed:
+                raise KeyError(sid)
+            out = session.step(frame, mask)
+            session.last_used = time.time()
+        return {'mask': self.postprocess(out, size, session.palette)}
+
+    def close_session(self, sid):
+        with self.lock:
+            session = self.sessions.pop(sid)
+        self.release(session)
+        return {}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, fn, *args):
+        try:
+            self.reply(200, fn(*args))
+        except KeyError as e:
+            self.reply(404, {'error': 'unknown session or field {}'.format(e)})
+        except Exception as e:
+            self.reply(400, {'error': str(e)})
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['sessions']:
+            self.handle_request(self.server.create, self.read_json())
+        elif len(parts) == 2 and parts[0] == 'sessions':
+            self.handle_request(self.server.step, parts[1], self.read_json())
+        else:
+            self.reply(404, {'error': 'unknown path'})
+
+    def do_DELETE(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'sessions':
+            self.handle_request(self.server.close_session, parts[1])
+        else:
+            self.reply(404, {'error': 'unknown path'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+
+    args = parse_args()
+    print(opt)
+    # Use CUDA
+    device = 'cuda:{}'.format(args.gpu)
+    use_gpu = torch.cuda.is_available() and int(args.gpu) >= 0
+    if not use_gpu:
+        device = 'cpu'
+
+    # Model
+    print("==> creating model")
+
+    net = build_model(args.model, pretrained=not args.checkpoint)
+    print('    Total params: %.2fM' % (sum(p.numel() for p in net.parameters())/1000000.0))
+
+    # set eval to freeze batchnorm update
+    net.eval()
+    net.to(device)
+
+    for p in net.parameters():
+        p.requires_grad = False
+
+    if args.checkpoint:
+        # Load checkpoint.
+        print('==> Loading checkpoint {}'.format(args.checkpoint))
+        checkpoint = torch.load(args.checkpoint, map_location=device)
+        net.load_param(checkpoint['state_dict'])
+
+    server = Server((args.host, args.port), net, device, args)
+    print('==> Serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    server.memorizer.close()
+    server.encoder.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,9 @@ from libs.utils.logger import Logger, AverageMeter
 from libs.utils.loss import *
 from libs.utils.utility import write_mask, save_checkpoint, adjust_learning_rate, mask_iou, davis2017_eval
 from libs.models.models import STM
+from libs.models.memory_bank import MemoryBank
+from libs.davis2017.evaluation import DAVISEvaluation
+from libs.dataset.data import ROOT_DAVIS
 
 import torch
 import torch.nn as nn
@@ -17,6 +20,8 @@ import os.path as osp
 import shutil
 import time
 import pickle
+import glob
+import re
 from progress.bar import Bar
 from collections import OrderedDict
 import argparse
@@ -28,10 +33,29 @@ MAX_FLT = 1e6
 
 def parse_args():
     parser = argparse.ArgumentParser('Testing Mask Segmentation')
-    parser.add_argument('--checkpoint', default='', type=str, help='checkpoint to test the network')
+    parser.add_argument('--checkpoint', default=[], type=str, nargs='*', help='checkpoints (or glob patterns) to test the network, all evaluated in one run')
     parser.add_argument('--gpu', default='0', type=str, help='set gpu id to test the network')
     return parser.parse_args()
 
+def expand_checkpoints(patterns):
+    checkpoints = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            # natural order, e.g. recurrent_99 before recurrent_101
+            checkpoints += sorted(glob.glob(pattern), key=lambda p: [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', p)])
+        else:
+            checkpoints.append(pattern)
+    return checkpoints
+
+def cache_batches(testloader):
+    # decode and transform every video once, only the masks read by test() are kept
+    batches = []
+    for frames, masks, objs, infos in testloader:
+        if 'frame' not in infos[0]:
+            masks = masks[:, :1].clone()
+        batches.append((frames, masks, objs, infos))
+    return batches
+
 def main():
     
     args = parse_args()
@@ -58,7 +82,11 @@ def main():
     # Model
     print("==> creating model")
 
-    net = STM(opt.keydim, opt.valdim)
+    checkpoints = expand_checkpoints(args.checkpoint)
+    assert len(checkpoints) > 0 or not args.checkpoint, 'Error: no checkpoint found!'
+
+    # the ImageNet initialisation is overwritten by the checkpoint, skip downloading it
+    net = STM(opt.keydim, opt.valdim, top_k=opt.top_k, pretrained=not checkpoints, precision=opt.precision)
     print('    Total params: %.2fM' % (sum(p.numel() for p in net.parameters())/1000000.0))
 
     # set eval to freeze batchnorm update
@@ -74,27 +102,44 @@ def main():
     # Resume
     title = 'STM'
 
-    if args.checkpoint:
-        # Load checkpoint.
-        print('==> Loading checkpoint {}'.format(args.checkpoint))
-        assert os.path.isfile(args.checkpoint), 'Error: no checkpoint directory found!'
-        checkpoint = torch.load(args.checkpoint, map_location=device)
-        state = checkpoint['state_dict']
-        net.load_param(state)
-
-    # Test
-    print('==> Runing model on dataset {}, totally {:d} videos'.format(opt.valset, len(testloader)))
-
-    test(testloader,
-        model=net,
-        use_cuda=use_gpu,
-        device=device,
-        opt=opt)
-
-    print('==> Results are saved at: {}'.format(os.path.join(opt.results, opt.valset)))
-    
-    # Test davis 2017
-    davis2017_eval(results_path=os.path.join(opt.results, opt.valset))
+    # several checkpoints share the decoded videos and the ground truth, only the weights are swapped
+    dataset_eval = None
+    if len(checkpoints) > 1:
+        print('==> Caching dataset %s for %d checkpoints' % (opt.valset, len(checkpoints)))
+        testloader = cache_batches(testloader)
+        dataset_eval = DAVISEvaluation(davis_root=ROOT_DAVIS, task='semi-supervised', gt_set='val', cache=True)
+
+    results = []
+    for checkpoint in (checkpoints or [None]):
+        if checkpoint:
+            # Load checkpoint.
+            print('==> Loading checkpoint {}'.format(checkpoint))
+            assert os.path.isfile(checkpoint), 'Error: no checkpoint directory found!'
+            state = torch.load(checkpoint, map_location=device)['state_dict']
+            net.load_param(state)
+
+        # Test
+        print('==> Runing model on dataset {}, totally {:d} videos'.format(opt.valset, len(testloader)))
+
+        test(testloader,
+            model=net,
+            use_cuda=use_gpu,
+            device=device,
+            opt=opt)
+
+        print('==> Results are saved at: {}'.format(os.path.join(opt.results, opt.valset)))
+        
+        # Test davis 2017
+        table = davis2017_eval(results_path=os.path.join(opt.results, opt.valset), dataset_eval=dataset_eval, return_table=True)
+        table.insert(0, 'Checkpoint', os.path.basename(checkpoint) if checkpoint else '')
+        results.append(table)
+
+    if len(results) > 1:
+        table = pd.concat(results, ignore_index=True)
+        csv_path = os.path.join(opt.results, opt.valset, 'checkpoint_results.csv')
+        table.to_csv(csv_path, index=False, float_format="%.3f")
+        print('==> Results of all checkpoints saved in {}'.format(csv_path))
+        print(table.to_string(index=False))
     
 
 def test(testloader, model, use_cuda, device, opt):
@@ -124,8 +169,7 @@ def test(testloader, model, use_cuda, device, opt):
             # compute output
             
             pred = [masks[0:1]]
-            keys = []
-            vals = []
+            memory = MemoryBank(capacity=(T-2) // opt.save_freq + 1, max_size=opt.memory_size, policy=opt.memory_policy)
             for t in range(1, T):
                 if t-1 == 0:
                     tmp_mask = masks[0:1]
@@ -140,19 +184,21 @@ def test(testloader, model, use_cuda, device, opt):
                 t1 = time.time()
                 # memorize
                 key, val, _ = model(frame=frames[t-1:t, :, :, :], mask=tmp_mask, num_objects=num_objects)
+                memory.write(key, val, keep=(t-1) % opt.save_freq == 0)
+
+                # encode the query features of the upcoming frames in one batch
+                if (t-1) % opt.lookahead == 0:
+                    query = model.encode_query(frames[t:t+opt.lookahead, :, :, :])
+                i = (t-1) % opt.lookahead
 
                 # segment
-                tmp_key = torch.cat(keys+[key], dim=1)
-                tmp_val = torch.cat(vals+[val], dim=1)
-                logits, ps = model(frame=frames[t:t+1, :, :, :], keys=tmp_key, values=tmp_val, num_objects=num_objects, max_obj=max_obj)
+                logits, ps = model(frame=frames[t:t+1, :, :, :], memory=memory, query=[q[i:i+1] for q in query], 
+                    num_objects=num_objects, max_obj=max_obj)
 
                 out = torch.softmax(logits, dim=1)
 
                 pred.append(out)
 
-                if (t-1) % opt.save_freq == 0:
-                    keys.append(key)
-                    vals.append(val)
                 # _, idx = torch.max(out, dim=1)
 
                 toc = time.time() - t1
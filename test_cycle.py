@@ -4,6 +4,7 @@ from libs.utils.logger import Logger, AverageMeter
 from libs.utils.loss import *
 from libs.utils.utility import write_mask, save_checkpoint, adjust_learning_rate, mask_iou
 from libs.models.models import STM
+from libs.models.memory_bank import MemoryBank
 
 import torch
 import torch.nn as nn
@@ -47,7 +48,8 @@ def main():
     # Model
     print("==> creating model")
 
-    net = STM(opt.keydim, opt.valdim)
+    # the ImageNet initialisation is overwritten by the checkpoint, skip downloading it
+    net = STM(opt.keydim, opt.valdim, top_k=opt.top_k, pretrained=not opt.resume, precision=opt.precision)
     print('    Total params: %.2fM' % (sum(p.numel() for p in net.parameters())/1000000.0))
 
     # set eval to freeze batchnorm update
@@ -121,8 +123,7 @@ def test(testloader, model, criterion, use_cuda, opt):
         # compute output
             
         pred = [masks[0:1]]
-        keys = []
-        vals = []
+        memory = MemoryBank(capacity=(T-2) // opt.save_freq + 1, max_size=opt.memory_size, policy=opt.memory_policy)
         for t in range(1, T):
             if t-1 == 0:
                 tmp_mask = masks[0:1]
@@ -137,11 +138,16 @@ def test(testloader, model, criterion, use_cuda, opt):
             t1 = time.time()
             # memorize
             key, val, _ = model(frame=frames[t-1:t, :, :, :], mask=tmp_mask, num_objects=num_objects)
+            memory.write(key, val, keep=(t-1) % opt.save_freq == 0)
+
+            # encode the query features of the upcoming frames in one batch
+            if (t-1) % opt.lookahead == 0:
+                query = model.encode_query(frames[t:t+opt.lookahead, :, :, :])
+            i = (t-1) % opt.lookahead
 
             # segment
-            tmp_key = torch.cat(keys+[key], dim=1)
-            tmp_val = torch.cat(vals+[val], dim=1)
-            logits, ps = model(frame=frames[t:t+1, :, :, :], keys=tmp_key, values=tmp_val, num_objects=num_objects, max_obj=max_obj)
+            logits, ps = model(frame=frames[t:t+1, :, :, :], memory=memory, query=[q[i:i+1] for q in query], 
+                num_objects=num_objects, max_obj=max_obj)
 
             out = torch.softmax(logits, dim=1)
 
@@ -170,9 +176,6 @@ def test(testloader, model, criterion, use_cuda, opt):
             else:
                 pred.append(out)
 
-            if (t-1) % opt.save_freq == 0:
-                keys.append(key)
-                vals.append(val)
             # _, idx = torch.max(out, dim=1)
 
             toc = time.time() - t1
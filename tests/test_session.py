@@ -0,0 +1,39 @@
+import torch
+
+from libs.models.models import STM
+from libs.models.session import VOSSession
+
+
+def one_hot(label, max_obj):
+    return torch.nn.functional.one_hot(label, max_obj+1).permute(2, 0, 1).unsqueeze(0).float()
+
+
+def test_session_starts_without_objects():
+    torch.manual_seed(0)
+    model = STM(128, 512, pretrained=False).eval()
+    max_obj = 3
+    frames = torch.randn(4, 1, 3, 64, 64)
+
+    empty = one_hot(torch.zeros(64, 64, dtype=torch.long), max_obj)
+    session = VOSSession(model, frames[0], empty, save_freq=5)
+    assert session.num_objects == 0
+
+    # no object yet, the frame is background and nothing is memorized
+    out = session.step(frames[1])
+    assert out.shape == (1, max_obj+1, 64, 64)
+    assert torch.all(out[:, 0] == 1)
+    assert len(session.memory) == 0
+
+    # the first object appears with an annotation of the frame
+    label = torch.zeros(64, 64, dtype=torch.long)
+    label[16:40, 16:40] = 1
+    out = session.step(frames[2], one_hot(label, max_obj))
+    assert torch.all(out[:, 0] == 1)
+    assert session.num_objects == 1
+
+    # from then on the object is tracked from the memorized annotation
+    out = session.step(frames[3])
+    assert out.shape == (1, max_obj+1, 64, 64)
+    assert len(session.memory) == 1
+    assert torch.allclose(out.sum(dim=1), torch.ones(1, 64, 64))
+    assert out[0, 1].max() > 0
@@ -1,10 +1,11 @@
-from libs.dataset.data import DATA_CONTAINER, multibatch_collate_fn
+from libs.dataset.data import DATA_CONTAINER, multibatch_collate_fn, batch_count_objects
 from libs.dataset.image_data import COCODataset
-from libs.dataset.transform import TrainTransform, TestTransform
+from libs.dataset.transform import TrainTransform, TestTransform, BatchAugment
 from libs.utils.logger import set_logging, AverageMeter
 from libs.utils.loss import *
 from libs.utils.utility import write_mask, save_checkpoint, adjust_learning_rate
 from libs.models.models import STM
+from libs.models.memory_bank import MemoryBank
 
 import torch
 import torch.nn as nn
@@ -69,7 +70,7 @@ def main():
 
     input_dim = opt.input_size
 
-    train_transformer = TrainTransform(size=input_dim)
+    train_transformer = TrainTransform(size=input_dim, device_augment=opt.device_augment)
     test_transformer = TestTransform(size=input_dim)
 
 
@@ -111,8 +112,10 @@ def main():
         samples_per_video=1
         )
         
+    # worker options are only accepted with worker processes
+    loader_args = {'persistent_workers': True, 'prefetch_factor': opt.prefetch_factor} if opt.workers > 0 else {}
     trainloader = data.DataLoader(trainset, batch_size=opt.train_batch, shuffle=True, pin_memory=True,
-                                  num_workers=opt.workers, collate_fn=multibatch_collate_fn, drop_last=True)
+                                  num_workers=opt.workers, collate_fn=multibatch_collate_fn, drop_last=True, **loader_args)
 
     testloader = data.DataLoader(testset, batch_size=1, shuffle=False, pin_memory=True,
                                  num_workers=opt.workers, collate_fn=multibatch_collate_fn)
@@ -120,7 +123,8 @@ def main():
     logger.info("==> creating model")
 
     net = STM(opt.keydim, opt.valdim, 'train', 
-            mode=opt.mode, iou_threshold=opt.iou_threshold)
+            mode=opt.mode, iou_threshold=opt.iou_threshold, top_k=opt.top_k, precision=opt.precision, 
+            grad_checkpoint=opt.checkpoint_activations)
     logger.info('    Total params: %.2fM' % (sum(p.numel() for p in net.parameters())/1000000.0))
     net.eval()
     if use_gpu:
@@ -135,14 +139,14 @@ def main():
 
     # Strateges
     criterion = None
-    celoss = cross_entropy_loss
+    celoss = batch_cross_entropy_loss
 
     if opt.loss == 'ce':
         criterion = celoss
     elif opt.loss == 'iou':
-        criterion = mask_iou_loss
+        criterion = batch_mask_iou_loss
     elif opt.loss == 'both':
-        criterion = lambda pred, target, obj: celoss(pred, target, obj) + mask_iou_loss(pred, target, obj)
+        criterion = lambda pred, target, obj: celoss(pred, target, obj) + batch_mask_iou_loss(pred, target, obj)
     else:
         raise TypeError('unknown training loss %s' % opt.loss)
     
@@ -160,6 +164,10 @@ def main():
     else:
         raise TypeError('unkown solver type %s' % opt.solver)
 
+    # fp16 gradients are scaled to avoid underflow, bf16 and fp32 need no scaling
+    # loss scaling is CUDA only, it stays disabled for cpu and bf16 / fp32 runs
+    scaler = torch.cuda.amp.GradScaler(enabled=opt.precision == 'fp16' and use_gpu)
+
     # Resume
     title = 'STM'
     minloss = float('inf')
@@ -208,6 +216,7 @@ def main():
                            model=net,
                            criterion=criterion,
                            optimizer=optimizer,
+                           scaler=scaler,
                            epoch=epoch,
                            use_cuda=use_gpu,
                            iter_size=opt.iter_size,
@@ -252,7 +261,7 @@ def main():
 
     logger.info('minimum loss: {}'.format(minloss))
 
-def train(trainloader, model, criterion, optimizer, epoch, use_cuda, iter_size, mode, threshold):
+def train(trainloader, model, criterion, optimizer, scaler, epoch, use_cuda, iter_size, mode, threshold):
     # switch to train mode
 
     data_time = AverageMeter()
@@ -262,6 +271,7 @@ def train(trainloader, model, criterion, optimizer, epoch, use_cuda, iter_size,
 
     bar = Bar('Processing', max=len(trainloader))
     optimizer.zero_grad()
+    augment = BatchAugment() if opt.device_augment else None
 
     for batch_idx, data in enumerate(trainloader):
         frames, masks, objs, infos = data
@@ -273,22 +283,19 @@ def train(trainloader, model, criterion, optimizer, epoch, use_cuda, iter_size,
             masks = masks.cuda()
             objs = objs.cuda()
 
+        if augment is not None:
+            frames, masks = augment(frames, masks, infos)
+            # count the objects left after augmentation as on the CPU path
+            objs = batch_count_objects(masks)
+
         objs[objs==0] = 1
 
         N, T, C, H, W = frames.size()
         max_obj = masks.shape[2]-1
 
-        total_loss = 0.0
         out = model(frame=frames, mask=masks, num_objects=objs)
-        for idx in range(N):
-            for t in range(1, T):
-                gt = masks[idx, t:t+1]
-                pred = out[idx, t-1: t]
-                No = objs[idx].item()
-                    
-                total_loss = total_loss + criterion(pred, gt, No)
-
-        total_loss = total_loss / (N * (T-1))
+        # mean loss over the samples and frames
+        total_loss = criterion(out, masks[:, 1:], objs)
 
         # record loss
         if total_loss.item() > 0.0:
@@ -296,10 +303,11 @@ def train(trainloader, model, criterion, optimizer, epoch, use_cuda, iter_size,
 
         # compute gradient and do SGD step (divided by accumulated steps)
         total_loss /= iter_size
-        total_loss.backward()
+        scaler.scale(total_loss).backward()
 
         if (batch_idx+1) % iter_size == 0:
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             model.zero_grad()
 
         # measure elapsed time
@@ -342,8 +350,7 @@ def test(testloader, model, criterion, epoch, use_cuda):
 
             T, _, H, W = frames.shape
             pred = [masks[0:1]]
-            keys = []
-            vals = []
+            memory = MemoryBank(capacity=(T-2) // opt.save_freq + 1, max_size=opt.memory_size, policy=opt.memory_policy)
             for t in range(1, T):
                 if t-1 == 0:
                     tmp_mask = masks[0:1]
@@ -357,18 +364,13 @@ def test(testloader, model, criterion, epoch, use_cuda):
 
                 # memorize
                 key, val, _ = model(frame=frames[t-1:t, :, :, :], mask=tmp_mask, num_objects=num_objects)
+                memory.write(key, val, keep=(t-1) % opt.save_freq == 0)
 
                 # segment
-                tmp_key = torch.cat(keys+[key], dim=1)
-                tmp_val = torch.cat(vals+[val], dim=1)
-                logits, ps = model(frame=frames[t:t+1, :, :, :], keys=tmp_key, values=tmp_val, num_objects=num_objects, max_obj=max_obj)
+                logits, ps = model(frame=frames[t:t+1, :, :, :], memory=memory, num_objects=num_objects, max_obj=max_obj)
 
                 out = torch.softmax(logits, dim=1)
                 pred.append(out)
-
-                if (t-1) % opt.save_freq == 0:
-                    keys.append(key)
-                    vals.append(val)
             
             pred = torch.cat(pred, dim=0)
             pred = pred.detach().cpu().numpy()